@@ -0,0 +1,83 @@
+"""Times DirtyRanges against the list of invalid lines it replaced
+
+python bench/dirty_ranges.py
+
+Validation used to keep the invalid lines as a plain list, merged with every
+invalidated range through a set and filtered and shifted by hand for
+removed lines. Both are fed the same invalidations and removed lines: a large
+paste followed by single line edits, and random edits with deletes. The
+ranges have to contain every line of the list. Lines inside a removed range
+are joined into its first line by DirtyRanges, so they can contain more.
+"""
+
+import os
+import sys
+import bisect
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin', 'jft'))
+
+from DirtyRanges import DirtyRanges
+
+def run_list(ops):
+	lines = []
+
+	for kind, first, last in ops:
+		if kind == 'add':
+			lines = list(set(lines + range(first, last + 1)))
+		else:
+			lines = filter(lambda x: x <= first or x >= last, lines)
+			lines.sort()
+
+			idx = bisect.bisect_left(lines, last)
+
+			for i in range(idx, len(lines)):
+				lines[i] -= last - first
+
+	return set(lines)
+
+def run_ranges(ops):
+	ranges = DirtyRanges()
+
+	for kind, first, last in ops:
+		if kind == 'add':
+			ranges.add(first, last + 1)
+		else:
+			ranges.remove_lines(first, last)
+
+	return set(ranges)
+
+def scenarios():
+	random.seed(0)
+
+	paste = [('add', 0, 20000)]
+	paste += [('add', l, l) for l in random.sample(xrange(20000), 2000)]
+
+	edits = [('add', l, l) for l in [random.randint(0, 20000) for i in range(2000)]]
+	edits += [('remove', l, l + 2) for l in [random.randint(0, 20000) for i in range(200)]]
+
+	return (('20k line paste + 2000 single line edits', paste),
+	        ('2000 random edits + 200 deletes', edits))
+
+def timed(f, ops):
+	started = time.time()
+	ret = f(ops)
+
+	return ret, time.time() - started
+
+if __name__ == '__main__':
+	ok = True
+
+	for name, ops in scenarios():
+		old, old_time = timed(run_list, ops)
+		new, new_time = timed(run_ranges, ops)
+
+		if not old.issubset(new):
+			print '%s: lines missing from the ranges: %s' % (name, sorted(old - new)[0:10])
+			ok = False
+
+		print '%-42s list %.3fs, ranges %.3fs' % (name, old_time, new_time)
+
+	if not ok:
+		sys.exit(1)
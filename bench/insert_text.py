@@ -0,0 +1,151 @@
+"""Checks the insert-text dispatch of BufferUtils against the old one, and
+times both per keystroke
+
+python bench/insert_text.py
+
+Needs pygtk. OldBufferUtils below keeps the dispatch from before the marks
+were pooled. Both get three handlers which log their calls and, at random
+from a fixed seed, insert text themselves or block each other. The calls and
+the resulting text have to be the same for every seed. Then single
+characters are typed at the end of a buffer with two handlers which do
+nothing, once with the handlers enabled and once with both blocked.
+"""
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin', 'jft'))
+
+import gtk
+
+from BufferUtils import BufferUtils
+
+class OldBufferUtils(BufferUtils):
+	def connect_insert_text(self, handler):
+		handlers = self.buffer.get_data('BufferUtilsInsertTextHandler')
+
+		if handlers == None:
+			id1 = self.buffer.connect('insert-text', self.on_insert_text)
+			id2 = self.buffer.connect_after('insert-text', self.on_insert_text_after)
+
+			self.buffer.set_data('BufferUtilsInsertTextHandler', {'ids': [id1, id2], 'handlers': {handler: True}})
+		else:
+			handlers['handlers'][handler] = True
+
+	def on_insert_text(self, buf, location, text, length):
+		self.begin_user_action()
+		self._insert_text_start = buf.create_mark(None, location, True)
+
+	def on_insert_text_after(self, buf, location, text, length):
+		handlers = self.buffer.get_data('BufferUtilsInsertTextHandler')
+
+		other = buf.create_mark(None, location, False)
+
+		for handler in handlers['handlers']:
+			if handlers['handlers'][handler]:
+				start = self.get_iter_at_mark(self._insert_text_start)
+				end = self.get_iter_at_mark(other)
+
+				handler(start, end)
+
+				if self._insert_text_start.get_deleted() or other.get_deleted():
+					break
+
+		if not self._insert_text_start.get_deleted():
+			self.delete_mark(self._insert_text_start)
+
+		if not other.get_deleted():
+			location.assign(self.get_iter_at_mark(other))
+			self.delete_mark(other)
+
+		self.end_user_action()
+
+class Handler:
+	# A fixed hash keeps the order of the handlers the same for both
+	def __init__(self, name, callback):
+		self.name = name
+		self.callback = callback
+
+	def __hash__(self):
+		return ord(self.name)
+
+	def __call__(self, start, end):
+		self.callback(self, start, end)
+
+def run_nested(cls, seed):
+	random.seed(seed)
+
+	buf = gtk.TextBuffer()
+	buf.set_text('abc\ndef')
+
+	utils = cls(buf)
+	log = []
+	depth = [0]
+
+	def callback(handler, start, end):
+		log.append((handler.name, start.get_offset(), end.get_offset()))
+
+		if depth[0] < 2 and random.random() < 0.4:
+			depth[0] += 1
+			buf.insert(end, random.choice(['\n', 'yy', ' z\n']))
+			depth[0] -= 1
+
+		if random.random() < 0.2:
+			utils.block_insert_text(handlers[random.randint(0, 2)])
+
+	handlers = [Handler(name, callback) for name in 'abc']
+
+	for handler in handlers:
+		utils.connect_insert_text(handler)
+
+	for i in range(5):
+		offset = random.randint(0, buf.get_char_count())
+		buf.insert(buf.get_iter_at_offset(offset), random.choice(['q', '\n', 'rr']))
+
+		if random.random() < 0.3:
+			utils.unblock_insert_text(handlers[random.randint(0, 2)])
+
+	return log, buf.get_text(*buf.get_bounds())
+
+def check(seeds):
+	for seed in range(seeds):
+		if run_nested(OldBufferUtils, seed) != run_nested(BufferUtils, seed):
+			print 'Dispatch differs for seed %d' % (seed,)
+			return False
+
+	print 'Same handler calls and text for %d seeds' % (seeds,)
+	return True
+
+def typing(cls, blocked, keys):
+	buf = gtk.TextBuffer()
+	utils = cls(buf)
+
+	handlers = [lambda start, end: None, lambda start, end: None]
+
+	for handler in handlers:
+		utils.connect_insert_text(handler)
+
+		if blocked:
+			utils.block_insert_text(handler)
+
+	started = time.time()
+
+	for i in xrange(keys):
+		buf.insert(buf.get_end_iter(), 'x')
+
+	return (time.time() - started) / keys * 1000000
+
+if __name__ == '__main__':
+	if not check(200):
+		sys.exit(1)
+
+	keys = 20000
+
+	print '%-10s %10s %10s' % ('handlers', 'old (us)', 'new (us)')
+
+	for blocked in (False, True):
+		print '%-10s %10.1f %10.1f' % (blocked and 'blocked' or 'enabled',
+		                               typing(OldBufferUtils, blocked, keys),
+		                               typing(BufferUtils, blocked, keys))
@@ -0,0 +1,89 @@
+"""Times compiling formulas with and without the precompiled format
+
+python bench/latex_format.py [formulas]
+
+Needs latex and pygtk. The static preamble of the template is dumped into a
+format in a temporary cache with LatexTemplate.prepare_format. The same
+formulas are then compiled with the full preamble and with the format, one
+at a time and in batches of 16 as the render queue does. Only latex is
+timed, dvipng does not depend on the format.
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+
+directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin', 'jft')
+sys.path.insert(0, directory)
+
+import glib
+
+from LatexCache import LatexCache
+from LatexRender import LatexTemplate
+
+def build_format(template, cache):
+	template.prepare_format(cache)
+	loop = glib.MainLoop()
+
+	def on_timeout():
+		if template.format == None and template._format_proc != None:
+			return True
+
+		loop.quit()
+		return False
+
+	glib.timeout_add(50, on_timeout)
+	loop.run()
+
+	return template.format
+
+def compile_batch(template, expressions, precompiled):
+	tmp = tempfile.mkdtemp(prefix='jft-bench-')
+
+	try:
+		file(os.path.join(tmp, 'formula.tex'), 'w').write(template.document(expressions, '0,0,0', precompiled))
+
+		cmd = 'cd "%s" && %s -halt-on-error -interaction=batchmode formula.tex' % (tmp, template.latex_command(precompiled))
+		null = file('/dev/null', 'w')
+
+		return subprocess.call(cmd, shell=True, stdout=null, stderr=null) == 0
+	finally:
+		shutil.rmtree(tmp, True)
+
+def timed(template, expressions, size, precompiled):
+	started = time.time()
+
+	for i in range(0, len(expressions), size):
+		if not compile_batch(template, expressions[i:i + size], precompiled):
+			print 'latex failed'
+			sys.exit(1)
+
+	return (time.time() - started) / len(expressions) * 1000
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	else:
+		count = 64
+
+	expressions = ['x^{%d} + \\alpha_{%d} = \\frac{1}{%d}' % (i, i, i + 1) for i in range(count)]
+
+	template = LatexTemplate(os.path.join(directory, 'template.tex'))
+	cache = LatexCache(tempfile.mkdtemp(prefix='jft-bench-cache-'))
+
+	try:
+		if build_format(template, cache) == None:
+			print 'Could not dump the format'
+			sys.exit(1)
+
+		print '%-8s %14s %14s' % ('batch', 'preamble (ms)', 'format (ms)')
+
+		for size in (1, 16):
+			print '%-8d %14.1f %14.1f' % (size,
+			                              timed(template, expressions, size, False),
+			                              timed(template, expressions, size, True))
+	finally:
+		shutil.rmtree(cache.directory, True)
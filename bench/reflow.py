@@ -0,0 +1,73 @@
+"""Times reflowing a large outline, from the gedit python console
+
+With the jft plugin and the python console plugin enabled, run in the
+console of a gedit window:
+
+  execfile('/path/to/jft/bench/reflow.py')
+
+A new document in JFT mode is filled with a random outline of list items,
+headers, comments and text, generated from a fixed seed. The whole document
+is then reflowed as "Q" does, once for the string work in
+reflow_paragraphs only and once through reflow_lines, which also replaces
+the text in the buffer. A second reflow has to leave the document as it is.
+"""
+
+import random
+import time
+import gtksourceview2 as gsv
+
+from jft import Constants
+
+words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'a', 'consectetur',
+         '$x^2$', '$\\alpha + \\beta$', '{{link: a label}}', '{{doc: x}}']
+
+def outline_line():
+	k = random.random()
+	body = ' '.join([random.choice(words) for i in range(random.randint(0, 25))])
+
+	if k < 0.3:
+		return random.choice(['', '  ', '\t', '\t\t']) + \
+		       random.choice(['*', '**', '***', '1)', '1.2)']) + ' ' + body
+	elif k < 0.4:
+		return random.choice(['%', '#', '  # ']) + body
+	elif k < 0.5:
+		return ''
+	else:
+		return random.choice(['', '  ', '\t']) + body
+
+def run(window, lines = 10000):
+	random.seed(12)
+	text = '\n'.join([outline_line() for i in range(lines)])
+
+	tab = window.create_tab(True)
+	view = tab.get_view()
+	buf = view.get_buffer()
+
+	buf.set_language(gsv.language_manager_get_default().get_language('jft'))
+	buf.set_text(text)
+
+	helper = view.get_data(Constants.DOCUMENT_HELPER_KEY)
+	last = buf.get_line_count() - 1
+
+	started = time.time()
+	helper.reflow_paragraphs(text.split('\n'))
+	print 'reflow_paragraphs, %d lines: %.3fs' % (lines, time.time() - started)
+
+	started = time.time()
+	error = helper.reflow_lines(0, last)
+	print 'reflow_lines, %d lines: %.3fs' % (lines, time.time() - started)
+
+	if error != None:
+		print 'Could not reflow, %s' % (error,)
+		return
+
+	reflowed = buf.get_text(*buf.get_bounds())
+
+	started = time.time()
+	helper.reflow_lines(0, buf.get_line_count() - 1)
+	print 'reflow_lines again: %.3fs' % (time.time() - started,)
+
+	if buf.get_text(*buf.get_bounds()) != reflowed:
+		print 'The second reflow changed the document'
+
+run(window)
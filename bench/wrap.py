@@ -0,0 +1,137 @@
+"""Checks Wrap against the wrapping it replaced, and times both
+
+python bench/wrap.py [lines]
+
+The old _meta_line_length and _break_for_wrap of DocumentHelper are kept
+below. Both split a corpus of random lines, built from a fixed seed out of
+words, spaces, tabs, math, meta tags and stray braces, and every split has
+to be the same. Then both are timed on long lines of prose and of meta
+tags and math.
+"""
+
+import os
+import sys
+import re
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin', 'jft'))
+
+from Wrap import Wrap
+
+TABSIZE = 4
+
+def old_meta_line_length(line):
+	l = len(line) + (TABSIZE - 1) * line.count("\t")
+
+	r = re.compile('\{\{.*?:\s*(.*?)\s*\}\}')
+
+	for item in r.finditer(line):
+		l -= len(item.group(0)) - len(item.group(1))
+
+	r = re.compile('\$.*?\$')
+	r2 = re.compile('\\\\[a-z]+')
+
+	for item in r.finditer(line):
+		l -= 2
+
+		for i2 in r2.finditer(item.group(0)):
+			l -= len(i2.group(0)) - 1
+
+	return l
+
+def old_break_for_wrap(line, border):
+	unbreakable = []
+	ubp = ('$}', '${')
+	last = None
+
+	if old_meta_line_length(line) < border:
+		return None, None
+
+	for i in range(len(line) - 1, 1, -1):
+		first = line[0:i]
+
+		if line[i] in ubp[1] and \
+		   unbreakable and \
+		   unbreakable[-1] == ubp[0][ubp[1].index(line[i])]:
+			unbreakable.pop()
+		elif line[i] in ubp[0]:
+			unbreakable.append(line[i])
+
+		if not unbreakable and line[i].isspace():
+			if old_meta_line_length(first) < border:
+				second = line[i + 1:]
+
+				if old_meta_line_length(second) > border - 1:
+					break
+
+				return first, second
+			else:
+				last = i
+
+	if last != None:
+		return line[0:last], line[last + 1:]
+	else:
+		return None, None
+
+pieces = ['word', 'a', 'lorem', ' ', ' ', '  ', '\t', '$x$', '$\\alpha + \\beta$',
+          '$', '{{link: label}}', '{{a}}', '{', '}', ':', '{{x:  y  }}', '\\frac',
+          'ab cd', '{{', '}}', '\xc3\xa9']
+
+def check(count):
+	random.seed(1)
+	wrap = Wrap(TABSIZE)
+	split = 0
+
+	for i in xrange(count):
+		line = ''.join([random.choice(pieces) for j in range(random.randint(0, 40))])
+		border = random.randint(1, 80)
+
+		old = old_break_for_wrap(line, border)
+		new = wrap.split(line, border)
+
+		if old != new:
+			print 'Differs for %r at border %d: %r != %r' % (line, border, old, new)
+			return False
+
+		if new[0] != None:
+			split += 1
+
+	print 'Same split for %d lines, %d of them split' % (count, split)
+	return True
+
+def timed(f, line, repeat):
+	started = time.time()
+
+	for i in xrange(repeat):
+		f(line, 79)
+
+	return (time.time() - started) / repeat * 1000
+
+def benchmark():
+	units = (('prose', 'lorem ipsum dolor sit amet '),
+	         ('meta and math', 'see {{doc: the label}} and $\\alpha + x$ then '))
+
+	wrap = Wrap(TABSIZE)
+
+	print '%-14s %6s %10s %10s' % ('line', 'length', 'old (ms)', 'new (ms)')
+
+	for name, unit in units:
+		for size in (120, 400, 2000, 10000):
+			line = (unit * (size / len(unit) + 1))[0:size]
+			repeat = size >= 2000 and 20 or 500
+
+			print '%-14s %6d %10.3f %10.3f' % (name, size,
+			                                   timed(old_break_for_wrap, line, repeat),
+			                                   timed(wrap.split, line, repeat))
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	else:
+		count = 200000
+
+	if not check(count):
+		sys.exit(1)
+
+	benchmark()
@@ -68,7 +68,13 @@ class BufferUtils:
 			id1 = self.buffer.connect('insert-text', self.on_insert_text)
 			id2 = self.buffer.connect_after('insert-text', self.on_insert_text_after)
 
-			self.buffer.set_data('BufferUtilsInsertTextHandler', {'ids': [id1, id2], 'handlers': {handler: True}})
+			# Marks are kept for reuse by their gravity, inserts are counted
+			# to see when a handler inserted text itself
+			self.buffer.set_data('BufferUtilsInsertTextHandler', {'ids': [id1, id2],
+			                                                      'handlers': {handler: True},
+			                                                      'starts': [],
+			                                                      'marks': {True: [], False: []},
+			                                                      'inserts': 0})
 		else:
 			handlers['handlers'][handler] = True
 
@@ -85,35 +91,59 @@ class BufferUtils:
 				for i in handlers['ids']:
 					self.buffer.disconnect(i)
 
+				for marks in handlers['marks'].values():
+					for mark in marks:
+						self.buffer.delete_mark(mark)
+
 				self.buffer.set_data('BufferUtilsInsertTextHandler', None)
 
 	def __getattr__(self, name):
 		return getattr(self.buffer, name)
 
+	def _take_mark(self, handlers, location, left_gravity):
+		marks = handlers['marks'][left_gravity]
+
+		if not marks:
+			return self.buffer.create_mark(None, location, left_gravity)
+
+		mark = marks.pop()
+		self.buffer.move_mark(mark, location)
+
+		return mark
+
 	def on_insert_text(self, buf, location, text, length):
+		handlers = self.buffer.get_data('BufferUtilsInsertTextHandler')
+		handlers['inserts'] += 1
+
+		# Nothing to track while all handlers are blocked
+		if not True in handlers['handlers'].itervalues():
+			handlers['starts'].append(None)
+			return
+
 		self.begin_user_action()
-		self._insert_text_start = buf.create_mark(None, location, True)
+		handlers['starts'].append(self._take_mark(handlers, location, True))
 
 	def on_insert_text_after(self, buf, location, text, length):
 		handlers = self.buffer.get_data('BufferUtilsInsertTextHandler')
+		start = handlers['starts'].pop()
 
-		other = buf.create_mark(None, location, False)
+		if start == None:
+			return
 
-		for handler in handlers['handlers']:
-			if handlers['handlers'][handler]:
-				start = self.get_iter_at_mark(self._insert_text_start)
-				end = self.get_iter_at_mark(other)
+		other = self._take_mark(handlers, location, False)
+		inserts = handlers['inserts']
 
-				handler(start, end)
+		for handler in handlers['handlers'].keys():
+			if handlers['handlers'].get(handler):
+				handler(self.get_iter_at_mark(start), self.get_iter_at_mark(other))
 
-				if self._insert_text_start.get_deleted() or other.get_deleted():
+				# The rest is left to the inserts made by the handler
+				if handlers['inserts'] != inserts:
 					break
 
-		if not self._insert_text_start.get_deleted():
-			self.delete_mark(self._insert_text_start)
+		location.assign(self.get_iter_at_mark(other))
 
-		if not other.get_deleted():
-			location.assign(self.get_iter_at_mark(other))
-			self.delete_mark(other)
+		handlers['marks'][True].append(start)
+		handlers['marks'][False].append(other)
 
 		self.end_user_action()
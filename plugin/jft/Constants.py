@@ -1,2 +1,36 @@
 DOCUMENT_HELPER_KEY = 'DocumentHelperKey'
 VALIDATOR_KEY = 'ValidatorKey'
+VALIDATION_KEY = 'ValidationKey'
+STRUCTURE_KEY = 'StructureKey'
+
+# Hand render jobs to a separate worker process. It still runs latex and
+# dvipng in a temporary directory for every job, like rendering without it,
+# and only adds passing the jobs and images over a pipe
+LATEX_WORKER = False
+
+# Latex jobs running at the same time, None for the number of cpus, and the
+# most formulas rendered in a single job
+LATEX_MAX_RUNNING = None
+LATEX_BATCH_SIZE = 16
+
+# Quiet period after an edit before formulas are rendered (ms)
+LATEX_RENDER_DELAY = 300
+
+# Time spent revalidating lines per idle callback (ms)
+VALIDATION_BUDGET = 5
+
+# Only validate the lines around the view in documents of at least
+# LAZY_VALIDATION_LINES lines when they are opened, at least
+# VALIDATION_MARGIN lines above and below it. Ranges out of view for longer
+# than the expire time (s) are dropped again
+LAZY_VALIDATION = True
+LAZY_VALIDATION_LINES = 2000
+VALIDATION_MARGIN = 100
+VALIDATION_EXPIRE = 30
+
+# Pastes of at least this many lines are reindented and wrapped as a whole
+# and put in the buffer in one replace
+BATCH_REFLOW_LINES = 50
+
+# Check the validation index against the buffer marks after revalidating
+DEBUG_VALIDATION = False
@@ -0,0 +1,116 @@
+class Coverage:
+	"""Line ranges which have been validated
+
+	Every range remembers when it was last seen, so that ranges which have
+	been out of view for a while can be dropped again. Ranges follow line
+	insertions and deletions in the buffer.
+	"""
+
+	def __init__(self):
+		# Sorted list of [first, last, seen]
+		self._ranges = []
+
+	def __len__(self):
+		return len(self._ranges)
+
+	def lines(self):
+		return sum(map(lambda x: x[1] - x[0] + 1, self._ranges))
+
+	def clip(self, first, last):
+		"""clip(first, last) -> [(first, last), ...] parts which are covered"""
+
+		ret = []
+
+		for r in self._ranges:
+			if r[0] > last:
+				break
+
+			if r[1] >= first:
+				ret.append((max(r[0], first), min(r[1], last)))
+
+		return ret
+
+	def _uncovered(self, first, last, ranges):
+		ret = []
+		line = first
+
+		for r in ranges:
+			if r[1] < first or r[0] > last:
+				continue
+
+			if r[0] > line:
+				ret.append((line, r[0] - 1))
+
+			line = max(line, r[1] + 1)
+
+		if line <= last:
+			ret.append((line, last))
+
+		return ret
+
+	def extend(self, first, last, seen):
+		"""extend(first, last, seen) -> [(first, last), ...] newly covered"""
+
+		for r in self._ranges:
+			if r[1] >= first and r[0] <= last:
+				r[2] = seen
+
+		ret = self._uncovered(first, last, self._ranges)
+
+		for a, b in ret:
+			self._ranges.append([a, b, seen])
+
+		self._ranges.sort()
+		return ret
+
+	def expire(self, before):
+		"""expire(before) -> [(first, last), ...] no longer covered"""
+
+		expired = filter(lambda x: x[2] < before, self._ranges)
+
+		if not expired:
+			return []
+
+		self._ranges = filter(lambda x: x[2] >= before, self._ranges)
+		ret = []
+
+		for r in expired:
+			ret.extend(self._uncovered(r[0], r[1], self._ranges))
+
+		return ret
+
+	def insert_lines(self, line, count):
+		"""insert_lines(line, count) -> None
+
+		Count lines were inserted after line, a range containing line grows.
+		"""
+
+		for r in self._ranges:
+			if r[0] > line:
+				r[0] += count
+				r[1] += count
+			elif r[1] >= line:
+				r[1] += count
+
+	def remove_lines(self, first, last):
+		"""remove_lines(first, last) -> None
+
+		Lines after first, up to and including last, were joined into first.
+		"""
+
+		diff = last - first
+
+		def move(x):
+			if x <= first:
+				return x
+			elif x <= last:
+				return first
+			else:
+				return x - diff
+
+		for r in self._ranges:
+			r[0] = move(r[0])
+			r[1] = move(r[1])
+
+	def clear(self):
+		self._ranges = []
@@ -0,0 +1,177 @@
+from LineIndex import LineIndex
+
+class DirtyRanges:
+	"""Set of lines, stored as merged [start, end) ranges
+
+	The ranges are kept in a LineIndex, so that shifting them for inserted or
+	removed lines is O(log n).
+	"""
+
+	class Range(LineIndex.Node):
+		__slots__ = ('size',)
+
+		def __init__(self, size):
+			LineIndex.Node.__init__(self)
+			self.size = size
+
+	def __init__(self):
+		self._index = LineIndex()
+		self._lines = 0
+
+	def __len__(self):
+		return self._lines
+
+	def __iter__(self):
+		for node in self._index:
+			for line in range(node.line, node.line + node.size):
+				yield line
+
+	def ranges(self, start = None, end = None):
+		"""ranges(start, end) -> [start, end) ranges, clipped to start and end"""
+
+		if start == None:
+			return map(lambda x: (x.line, x.line + x.size), self._index)
+
+		ret = []
+
+		for node in self._overlapping(start, end):
+			first = max(node.line, start)
+			last = min(node.line + node.size, end)
+
+			if first < last:
+				ret.append((first, last))
+
+		return ret
+
+	def _insert(self, start, end):
+		self._index.insert(DirtyRanges.Range(end - start), start)
+		self._lines += end - start
+
+	def _remove(self, node):
+		self._index.remove(node)
+		self._lines -= node.size
+
+	def _overlapping(self, start, end):
+		# Ranges overlapping [start, end), or adjacent to it
+		ret = []
+		prev = self._index.before(start - 1)
+
+		if prev != None and prev.line + prev.size >= start:
+			ret.append(prev)
+
+		return ret + self._index.between(start, end)
+
+	def contains(self, line):
+		prev = self._index.before(line)
+
+		return prev != None and line < prev.line + prev.size
+
+	def add(self, start, end):
+		if end <= start:
+			return
+
+		for node in self._overlapping(start, end):
+			start = min(start, node.line)
+			end = max(end, node.line + node.size)
+
+			self._remove(node)
+
+		self._insert(start, end)
+
+	def discard(self, start, end):
+		if end <= start:
+			return
+
+		for node in self._overlapping(start, end):
+			first, last = node.line, node.line + node.size
+
+			if last <= start or first >= end:
+				continue
+
+			self._remove(node)
+
+			if first < start:
+				self._insert(first, start)
+
+			if last > end:
+				self._insert(end, last)
+
+	def insert_lines(self, line, count):
+		"""insert_lines(line, count) -> None
+
+		Count lines were inserted after line, a range continuing after line
+		grows.
+		"""
+
+		prev = self._index.before(line)
+
+		if prev != None and prev.line + prev.size > line + 1:
+			prev.size += count
+			self._lines += count
+
+		self._index.shift(line + 1, count)
+
+	def remove_lines(self, first, last):
+		"""remove_lines(first, last) -> None
+
+		Lines after first, up to and including last, were joined into first.
+		"""
+
+		if last <= first:
+			return
+
+		diff = last - first
+
+		def move(x):
+			if x <= first:
+				return x
+			elif x <= last:
+				return first
+			else:
+				return x - diff
+
+		moved = []
+
+		for node in self._overlapping(first + 1, last + 1):
+			if node.line + node.size <= first + 1:
+				continue
+
+			self._remove(node)
+			moved.append((move(node.line), move(node.line + node.size - 1) + 1))
+
+		self._index.shift(last + 1, -diff)
+
+		# Keep the ranges merged where they now touch
+		node = self._index.after(first + 1)
+
+		if node != None and node.line == first + 1:
+			self._remove(node)
+			moved.append((node.line, node.line + node.size))
+
+		for start, end in moved:
+			self.add(start, end)
+
+	def nearest(self, first, last):
+		"""nearest(first, last) -> line closest to [first, last], or None"""
+
+		prev = self._index.before(last)
+
+		if prev != None and prev.line + prev.size > first:
+			return max(prev.line, first)
+
+		succ = self._index.after(last + 1)
+
+		if prev == None and succ == None:
+			return None
+		elif prev == None:
+			return succ.line
+		elif succ == None:
+			return prev.line + prev.size - 1
+		elif succ.line - last <= first - (prev.line + prev.size - 1):
+			return succ.line
+		else:
+			return prev.line + prev.size - 1
+
+	def clear(self):
+		self._index.clear()
+		self._lines = 0
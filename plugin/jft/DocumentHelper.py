@@ -11,6 +11,8 @@ import gio
 from Signals import Signals
 from BufferUtils import BufferUtils
 from Validation import Validation
+from Wrap import Wrap
+from Structure import Structure
 from ExportLatex import ExportLatex
 from ExportHtml import ExportHtml
 
@@ -25,16 +27,17 @@ class DocumentHelper(Signals):
         self._view = view
         self._buffer = None
         self.validation = None
+        self.structure = None
+
+        self._re_any_tag = re.compile('^\s*(\**|[0-9][.0-9]*\))(\s*)((DONE|CHECK|TODO|DEADLINE):\s*(\([0-9]{1,2}((\s*(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*)|-[0-9]{1,2}(-[0-9]{2,})?|(January|February|April|May|June|July|August|September|October|November|December))\))?\s* ?)?')
+        self._re_list = re.compile('^(\s*)(\*+|[0-9][.0-9]*\))(\s*)')
+        self._re_continuations = re.compile('^(\s*)((#+|%+)\s*)')
 
         self.connect_signal(self._view, 'notify::buffer', self.on_notify_buffer)
         self.reset_buffer(self._view.get_buffer())
 
         self.initialize_event_handlers()
 
-        self._re_any_tag = re.compile('^\s*(\**|[0-9][.0-9]*\))(\s*)((DONE|CHECK|TODO|DEADLINE):\s*(\([0-9]{1,2}((\s*(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*)|-[0-9]{1,2}(-[0-9]{2,})?|(January|February|April|May|June|July|August|September|October|November|December))\))?\s* ?)?')
-        self._re_list = re.compile('^(\s*)(\*+|[0-9][.0-9]*\))(\s*)')
-        self._re_continuations = re.compile('^(\s*)((#+|%+)\s*)')
-
     def reset_buffer(self, newbuf):
         self._in_mode = False
 
@@ -50,10 +53,25 @@ class DocumentHelper(Signals):
                 self._buffer.disconnect_insert_text(self.on_insert_text)
 
             if self.validation:
-                self.validation.stop()
+                self.validation.release(self._view)
+                self.validation = None
+
+            if self.structure:
+                self.structure.release()
+                self.structure = None
         else:
             self.connect_signal(self._view, 'key-press-event', self.on_key_press_event)
-            self.validation = Validation(self._view)
+
+            if self.validation:
+                self.validation.release(self._view)
+
+            # Validation is shared between all views of the buffer
+            self.validation = Validation.acquire(self._view)
+
+            if self.structure:
+                self.structure.release()
+
+            self.structure = Structure.acquire(newbuf, self._re_list, self._re_any_tag)
             self.connect_signal(newbuf, 'load', self.on_document_load)
             self.connect_signal(newbuf, 'loaded', self.on_document_loaded)
 
@@ -61,8 +79,6 @@ class DocumentHelper(Signals):
             if self._buffer:
                 self.disconnect_signals(self._buffer.buffer)
 
-                self.validation = None
-
             if newbuf:
                 self._buffer = BufferUtils(newbuf)
                 self.connect_signal(newbuf, 'notify::language', self.on_notify_language)
@@ -88,6 +104,8 @@ class DocumentHelper(Signals):
             [('KP_Enter', 'ISO_Enter', 'Return'), gdk.CONTROL_MASK, self.do_auto_indent, False],
             [('p',), 0, self.do_export_pdf, True],
             [('h',), 0, self.do_export_html, True],
+            [('q',), 0, self.do_reflow_paragraph, True],
+            [('Q',), gdk.SHIFT_MASK, self.do_reflow_document, True],
         ]
 
         for handler in self._event_handlers:
@@ -169,11 +187,10 @@ class DocumentHelper(Signals):
         else:
             return '\t', len(indent.replace(' ', '')) + indent.count(' ') / width
 
-    def reindent_ul(self, start, end, indent, match, num):
-        self._buffer.delete(start, end)
-        self._buffer.insert(start, indent * num + '*' * num)
+    def reindented_ul(self, indent, match, num):
+        return indent * num + '*' * num
 
-    def reindent_ol(self, start, end, indent, match, num):
+    def reindented_ol(self, indent, match, num):
         orig = match.group(2)[0:-1].split('.')
 
         if len(orig) >= num:
@@ -182,14 +199,19 @@ class DocumentHelper(Signals):
             newt = list(orig)
             newt.extend(['1' for x in xrange(0, num - len(orig))])
 
-        self._buffer.delete(start, end)
-        self._buffer.insert(start, (indent * num) + '.'.join(newt) + ')')
+        return (indent * num) + '.'.join(newt) + ')'
+
+    def reindented_list(self, indent, match, num):
+        """reindented_list(indent, match, num) -> new start of the list item"""
 
-    def reindent_list(self, start, end, indent, match, num):
         if '*' in match.groups(2):
-            self.reindent_ul(start, end, indent, match, num)
+            return self.reindented_ul(indent, match, num)
         else:
-            self.reindent_ol(start, end, indent, match, num)
+            return self.reindented_ol(indent, match, num)
+
+    def reindent_list(self, start, end, indent, match, num):
+        self._buffer.delete(start, end)
+        self._buffer.insert(start, self.reindented_list(indent, match, num))
 
     def list_length(self, item):
         if '*' in item:
@@ -205,7 +227,7 @@ class DocumentHelper(Signals):
         reindenting are returned.
         """
 
-        offsets = range(start.get_line(), end.get_line() + 1)
+        offsets = self.structure.items(start.get_line(), end.get_line())
 
         # Create marks to keep track of the iters so we can return their new
         # positions
@@ -219,9 +241,6 @@ class DocumentHelper(Signals):
 
             match = self._re_list.match(line)
 
-            if not match:
-                continue
-
             # See if the indentation is correct
             idn, num = self.guess_indent(match.group(1))
             listlen = self.list_length(match.group(2))
@@ -254,7 +273,7 @@ class DocumentHelper(Signals):
             start, end, reindented = self.reindent_block(*bd)
             bounds = self._buffer.create_mark_range(start, end, True)
 
-        offsets = range(start.get_line(), end.get_line() + 1)
+        offsets = self.structure.items(start.get_line(), end.get_line())
         ret = False
 
         if not reindented:
@@ -262,10 +281,6 @@ class DocumentHelper(Signals):
                 line = self._buffer.line_at_offset(i)
 
                 match = self._re_list.match(line)
-
-                if not match:
-                    continue
-
                 ret = True
 
                 # See if current indent conforms to bullets
@@ -293,29 +308,23 @@ class DocumentHelper(Signals):
         return True
 
     def maybe_new_list_item(self, piter):
-        # Go back each line
-        start = piter.copy()
+        # Find the list item this line is part of
+        item = self.structure.parent_item(piter.get_line())
 
-        while start.backward_line():
-            line = self._buffer.line_at_iter(start)
-
-            if line.strip() == '' or (not line.startswith(' ') and not line.startswith('\t')):
-                return False
-
-            match = self._re_list.match(line)
+        if item == None:
+            return False
 
-            if match:
-                self._buffer.begin_user_action()
+        match = self._re_list.match(self._buffer.line_at_offset(item))
 
-                nt = self.next_list(match)
+        self._buffer.begin_user_action()
 
-                self._buffer.insert(piter, "\n%s%s%s" % (match.group(1), nt, match.group(3)))
-                self._buffer.end_user_action()
+        nt = self.next_list(match)
 
-                self._view.scroll_mark_onscreen(self._buffer.get_insert())
-                return True
+        self._buffer.insert(piter, "\n%s%s%s" % (match.group(1), nt, match.group(3)))
+        self._buffer.end_user_action()
 
-        return False
+        self._view.scroll_mark_onscreen(self._buffer.get_insert())
+        return True
 
     def next_list(self, match):
         if '*' in match.group(2):
@@ -418,6 +427,43 @@ class DocumentHelper(Signals):
     def do_export_html(self, event):
         return self.do_export(ExportHtml)
 
+    def do_reflow(self, first, last):
+        self.exit_mode()
+
+        error = self.reflow_lines(first, last)
+
+        if error != None:
+            self.status_message('Could not reflow, %s' % (error,))
+
+        return True
+
+    def do_reflow_paragraph(self, event):
+        bounds = self._buffer.get_selection_bounds()
+
+        if bounds:
+            first, last = bounds[0].get_line(), bounds[1].get_line()
+        else:
+            first = last = self._buffer.insert_iter().get_line()
+
+        # Extend to the whole paragraphs
+        while first > 0 and self._wrap_reuse_line(self._buffer.line_at_offset(first)):
+            line = self._buffer.line_at_offset(first - 1)
+
+            if not self._re_list.match(line) and not self._wrap_reuse_line(line):
+                break
+
+            first -= 1
+
+        count = self._buffer.get_line_count()
+
+        while last + 1 < count and self._wrap_reuse_line(self._buffer.line_at_offset(last + 1)):
+            last += 1
+
+        return self.do_reflow(first, last)
+
+    def do_reflow_document(self, event):
+        return self.do_reflow(0, self._buffer.get_line_count() - 1)
+
     def on_key_press_event(self, doc, event):
         defmod = gtk.accelerator_get_default_mod_mask() & event.state
 
@@ -433,73 +479,406 @@ class DocumentHelper(Signals):
     def on_notify_buffer(self, view, spec):
         self.reset_buffer(view.get_buffer())
 
-    def _meta_line_length(self, line):
-        tabsize = self._view.get_tab_width()
-        l = len(line) + (tabsize - 1) * line.count("\t")
+    def _break_for_wrap(self, line, border):
+        return Wrap(self._view.get_tab_width()).split(line, border)
 
-        r = re.compile('\{\{.*?:\s*(.*?)\s*\}\}')
+    def _wrap_reuse_line(self, line):
+        return not (self._re_list.match(line) or line.strip() == "" or line.strip().startswith('%') or line.strip().startswith('#'))
 
-        for item in r.finditer(line):
-            l -= len(item.group(0)) - len(item.group(1))
+    def _wrap_reuse_next(self, offset):
+        start = self._buffer.get_iter_at_line(offset + 1)
 
-        r = re.compile('\$.*?\$')
-        r2 = re.compile('\\\\[a-z]+')
+        if start.get_line() == offset:
+            return False
 
-        for item in r.finditer(line):
-            l -= 2
+        end = start.copy()
+        end.forward_to_line_end()
 
-            for i2 in r2.finditer(item.group(0)):
-                l -= len(i2.group(0)) - 1
+        return self._wrap_reuse_line(start.get_text(end))
 
-        return l
+    def _replace_in_line(self, lines, marks, i, start, end, text):
+        # Marks keep to the right of an insertion, like the cursor does
+        line = lines[i]
+        lines[i] = line[0:start] + text + line[end:]
 
-    def _break_for_wrap(self, line, border):
-        tabsize = self._view.get_tab_width()
-        unbreakable = []
-        ubp = ('$}', '${')
-        last = None
+        for mark in marks:
+            if mark[0] == i and mark[1] >= start:
+                mark[1] = max(mark[1] - (end - start), start) + len(text)
+
+    def _append_line(self, lines, marks, i, text):
+        end = len(lines[i])
+        lines.insert(i + 1, text)
+
+        for mark in marks:
+            if mark[0] > i:
+                mark[0] += 1
+            elif mark[0] == i and mark[1] >= end:
+                mark[0] = i + 1
+                mark[1] = len(text)
+
+    def _backward_chars(self, lines, i, index, count):
+        while count > index and i > 0:
+            count -= index + 1
+            i -= 1
+            index = len(lines[i])
+
+        return [i, max(index - count, 0)]
+
+    def _common_affixes(self, old, new):
+        """_common_affixes(old, new) -> (prefix, suffix)
+
+        Lengths of the start and the end which old and new have in common,
+        on utf-8 character boundaries.
+        """
+
+        size = min(len(old), len(new))
+        low, high = 0, size
+
+        while low < high:
+            mid = (low + high + 1) / 2
+
+            if old[0:mid] == new[0:mid]:
+                low = mid
+            else:
+                high = mid - 1
+
+        prefix = low
+
+        while prefix > 0 and prefix < len(old) and (ord(old[prefix]) & 0xc0) == 0x80:
+            prefix -= 1
 
-        if self._meta_line_length(line) < border:
-            return None, None
+        low, high = 0, size - prefix
 
-        for i in range(len(line) - 1, 1, -1):
-            first = line[0:i]
+        while low < high:
+            mid = (low + high + 1) / 2
 
-            if line[i] in ubp[1] and \
-               unbreakable and \
-               unbreakable[-1] == ubp[0][ubp[1].index(line[i])]:
-                unbreakable.pop()
-            elif line[i] in ubp[0]:
-                unbreakable.append(line[i])
+            if old[len(old) - mid:] == new[len(new) - mid:]:
+                low = mid
+            else:
+                high = mid - 1
+
+        suffix = low
+
+        while suffix > 0 and (ord(old[-suffix]) & 0xc0) == 0x80:
+            suffix -= 1
+
+        return prefix, suffix
+
+    def _iter_at_offset(self, sl, text, offset):
+        # Offset in bytes in text, which starts at line sl of the buffer
+        line = text.count("\n", 0, offset)
+        index = offset - (text.rfind("\n", 0, offset) + 1)
+
+        return self._buffer.get_iter_at_line_index(sl + line, index)
+
+    def _reflow_reuse_next(self, lines, i, more):
+        # Pull in the lines looked at, like _wrap_reuse_next which reads up
+        # to the end of the next line after an empty line
+        while len(lines) < i + 3 and more(lines):
+            pass
+
+        if i + 1 >= len(lines):
+            return False
+
+        line = lines[i + 1]
+
+        if line == '' and i + 2 < len(lines):
+            line = "\n" + lines[i + 2]
+
+        return self._wrap_reuse_line(line)
+
+    def _reflow_lines(self, lines, last, marks, more):
+        """_reflow_lines(lines, last, marks, more) -> None
+
+        Reindents and wraps lines 0 up to and including last in the same way
+        on_insert_text does in the buffer. Marks are [line, index] positions,
+        the first one being the cursor, the second the selection bound. When
+        wrapping continues past the lines, more(lines) appends the next line
+        and returns False if there is none.
+        """
+
+        for i in xrange(0, last + 1):
+            match = self._re_list.match(lines[i])
+
+            if not match:
+                continue
+
+            idn, num = self.guess_indent(match.group(1))
+            listlen = self.list_length(match.group(2))
+
+            if match.group(1) != idn * num or num != listlen:
+                item = self.reindented_list(idn, match, listlen)
+                self._replace_in_line(lines, marks, i, 0, match.end(2), item)
 
-            if not unbreakable and line[i].isspace():
-                if self._meta_line_length(first) < border:
-                    second = line[i + 1:]
+        wrap = Wrap(self._view.get_tab_width())
+        border = self._view.get_right_margin_position()
+        i = 0
+
+        while i <= last:
+            line = lines[i]
+            orig, wrapped = wrap.split(line, border)
+
+            if wrapped:
+                ins = marks[0]
+                movecursor = ins[0] == i and ins[1] >= len(orig)
 
-                    if self._meta_line_length(second) > border - 1:
-                        break
+                if movecursor:
+                    moveinit = len(line) - ins[1]
 
-                    return first, second
+                self._replace_in_line(lines, marks, i, len(orig), len(line), '')
+
+                if self._reflow_reuse_next(lines, i, more):
+                    # Prepend wrapped text to next line
+                    start = len(lines[i + 1]) - len(lines[i + 1].lstrip())
+                    self._replace_in_line(lines, marks, i + 1, start, start, wrapped)
+                    start += len(wrapped)
+
+                    if not wrapped[-1].isspace():
+                        self._replace_in_line(lines, marks, i + 1, start, start, ' ')
+
+                    pos = i + 1, start
+
+                    if last == i:
+                        last += 1
                 else:
-                    last = i
+                    match = self._re_list.match(line)
 
-        if last != None:
-            return line[0:last], line[last + 1:]
-        else:
-            return None, None
+                    if match:
+                        idn, num = self.guess_indent(match.group(1))
+                        num = self.list_length(match.group(2))
 
-    def _wrap_reuse_next(self, offset):
-        start = self._buffer.get_iter_at_line(offset + 1)
+                        indent = "%s%s%s" % (idn * num, ' ' * len(match.group(2)), match.group(3))
+                    else:
+                        indent = lines[i][0:len(lines[i]) - len(lines[i].lstrip())]
 
-        if start.get_line() == offset:
+                    self._append_line(lines, marks, i, indent + wrapped)
+                    pos = i + 1, len(lines[i + 1])
+
+                    last += 1
+
+                if movecursor:
+                    marks[0] = self._backward_chars(lines, pos[0], pos[1], moveinit)
+                    marks[1] = list(marks[0])
+
+            i += 1
+
+    def reflow_batch(self, sl, el):
+        """reflow_batch(sl, el) -> True if the lines were reflowed
+
+        Reindents and wraps the lines from sl up to and including el outside
+        of the buffer, and replaces the part that changed at once. Lines with
+        formula anchors or other line endings are left to on_insert_text.
+        """
+
+        old = []
+        marks = []
+
+        for mark in (self._buffer.get_insert(), self._buffer.get_selection_bound()):
+            piter = self._buffer.get_iter_at_mark(mark)
+            marks.append([piter.get_line() - sl, piter.get_line_index()])
+
+        # Lines are read as they are needed, None marks a line which can not
+        # be reflowed here
+        def more(lines):
+            if old and old[-1] == None:
+                return False
+
+            start = self._buffer.get_iter_at_line(sl + len(old))
+
+            if start.get_line() != sl + len(old):
+                return False
+
+            end = start.copy()
+
+            if not end.ends_line():
+                end.forward_to_line_end()
+
+            line = start.get_slice(end)
+
+            if not end.get_char() in ["\n", "\0"] or u'\ufffc'.encode('utf-8') in line:
+                old.append(None)
+                return False
+
+            old.append(line)
+            lines.append(line)
+
+            return True
+
+        lines = []
+
+        while len(lines) <= el - sl + 1 and more(lines):
+            pass
+
+        if len(lines) <= el - sl:
             return False
 
-        end = start.copy()
-        end.forward_to_line_end()
+        self._reflow_lines(lines, el - sl, marks, more)
 
-        line = start.get_text(end)
+        if old[-1] == None:
+            return False
 
-        return not (self._re_list.match(line) or line.strip() == "" or line.strip().startswith('%') or line.strip().startswith('#'))
+        old = "\n".join(old)
+        new = "\n".join(lines)
+
+        if new == old:
+            return True
+
+        prefix, suffix = self._common_affixes(old, new)
+
+        self._buffer.begin_user_action()
+
+        start = self._iter_at_offset(sl, old, prefix)
+        self._buffer.delete(start, self._iter_at_offset(sl, old, len(old) - suffix))
+        self._buffer.insert(start, new[prefix:len(new) - suffix])
+
+        for mark, pos in zip((self._buffer.get_insert(), self._buffer.get_selection_bound()), marks):
+            if pos[0] >= 0 and pos[0] < len(lines):
+                self._buffer.move_mark(mark, self._buffer.get_iter_at_line_index(sl + pos[0], pos[1]))
+
+        self._buffer.end_user_action()
+        return True
+
+    def reflow_paragraphs(self, lines):
+        """reflow_paragraphs(lines) -> lines
+
+        Joins the lines of every paragraph and wraps them again at the right
+        margin. A paragraph is a list item or a run of text lines, blank
+        lines, headers and comments are kept as they are.
+        """
+
+        wrap = Wrap(self._view.get_tab_width())
+        border = self._view.get_right_margin_position()
+
+        ret = []
+        i = 0
+
+        while i < len(lines):
+            line = lines[i]
+            match = self._re_list.match(line)
+
+            if not match and not self._wrap_reuse_line(line):
+                ret.append(line)
+                i += 1
+                continue
+
+            # Continuation lines are indented like on_insert_text does
+            if match:
+                first = match.group(0)
+
+                idn, num = self.guess_indent(match.group(1))
+                num = self.list_length(match.group(2))
+
+                indent = "%s%s%s" % (idn * num, ' ' * len(match.group(2)), match.group(3))
+            else:
+                first = line[0:len(line) - len(line.lstrip())]
+                indent = first
+
+            start = i
+            parts = [line[len(first):]]
+            i += 1
+
+            while i < len(lines) and self._wrap_reuse_line(lines[i]):
+                parts.append(lines[i].strip())
+                i += 1
+
+            words = wrap.words(' '.join(parts))
+
+            if words:
+                ret.extend(wrap.fill(words, border, first, indent))
+            else:
+                ret.extend(lines[start:i])
+
+        return ret
+
+    def _text_position(self, text, count, before):
+        # Position after count non space characters, or before the next one
+        offset = 0
+
+        for line in text.split("\n"):
+            stripped = len(line.translate(None, Wrap.spaces))
+
+            if stripped >= count:
+                break
+
+            count -= stripped
+            offset += len(line) + 1
+
+        while offset < len(text) and (count > 0 or (before and text[offset].isspace())):
+            if not text[offset].isspace():
+                count -= 1
+
+            offset += 1
+
+        return offset
+
+    def reflow_lines(self, first, last):
+        """reflow_lines(first, last) -> None, or why the lines were not reflowed
+
+        Reflows the paragraphs in the lines from first up to and including
+        last in one user action. Only spaces change, so the text between two
+        formula anchors is replaced at once and the anchors stay in place.
+        """
+
+        start = self._buffer.get_iter_at_line(first)
+        end = self._buffer.get_iter_at_line(last)
+
+        if not end.ends_line():
+            end.forward_to_line_end()
+
+        old = start.get_slice(end)
+
+        if old.count("\n") != last - first or "\r" in old or u'\u2029'.encode('utf-8') in old:
+            return 'not all lines end in a newline'
+
+        new = "\n".join(self.reflow_paragraphs(old.split("\n")))
+
+        if new == old:
+            return None
+
+        if new.translate(None, Wrap.spaces) != old.translate(None, Wrap.spaces):
+            return 'reflowing would change more than spaces'
+
+        # Marks keep their place in the words
+        marks = []
+
+        for mark in (self._buffer.get_insert(), self._buffer.get_selection_bound()):
+            piter = self._buffer.get_iter_at_mark(mark)
+
+            if piter.in_range(start, end) or piter.equal(end):
+                text = start.get_slice(piter)
+                before = text != '' and text[-1].isspace()
+
+                marks.append((mark, len(text.translate(None, Wrap.spaces)), before))
+
+        anchor = u'\ufffc'.encode('utf-8')
+        edits = []
+        offset = 0
+
+        for a, b in zip(old.split(anchor), new.split(anchor)):
+            prefix, suffix = self._common_affixes(a, b)
+
+            if prefix + suffix < len(a) or len(a) != len(b):
+                edits.append((offset + prefix, offset + len(a) - suffix, b[prefix:len(b) - suffix]))
+
+            offset += len(a) + len(anchor)
+
+        self._buffer.block_insert_text(self.on_insert_text)
+        self._buffer.begin_user_action()
+
+        for s, e, text in reversed(edits):
+            piter = self._iter_at_offset(first, old, s)
+
+            self._buffer.delete(piter, self._iter_at_offset(first, old, e))
+            self._buffer.insert(piter, text)
+
+        for mark, count, before in marks:
+            offset = self._text_position(new, count, before)
+            self._buffer.move_mark(mark, self._iter_at_offset(first, new, offset))
+
+        self._buffer.end_user_action()
+        self._buffer.unblock_insert_text(self.on_insert_text)
+
+        return None
 
     def on_insert_text(self, start, end):
         self._buffer.block_insert_text(self.on_insert_text)
@@ -507,6 +886,11 @@ class DocumentHelper(Signals):
         sl = start.get_line()
         el = end.get_line()
 
+        # Large pastes are reindented and wrapped as a whole
+        if el - sl >= Constants.BATCH_REFLOW_LINES and self.reflow_batch(sl, el):
+            self._buffer.unblock_insert_text(self.on_insert_text)
+            return
+
         # First reindent block if there is more than 1 line of text
         if sl != el:
             start, end, reindented = self.reindent_block(start, end)
@@ -0,0 +1,185 @@
+import os
+import hashlib
+import shutil
+import tempfile
+
+class LatexCache:
+	def __init__(self, directory = None, max_size = 32 * 1024 * 1024):
+		if directory == None:
+			base = os.environ.get('XDG_CACHE_HOME')
+
+			if not base:
+				base = os.path.join(os.path.expanduser('~'), '.cache')
+
+			directory = os.path.join(base, 'jft')
+
+		self.directory = directory
+		self.max_size = max_size
+		self.low_water = 0.75
+
+		# Hits and misses of formula images, the lookups of other entries
+		# are only counted per extension
+		self.hits = 0
+		self.misses = 0
+		self.lookups = {}
+
+		self._size = None
+
+	def _ensure_directory(self):
+		if not os.path.isdir(self.directory):
+			try:
+				os.makedirs(self.directory)
+			except OSError:
+				return False
+
+		return True
+
+	def _entries(self):
+		ret = []
+
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return ret
+
+		for name in names:
+			path = os.path.join(self.directory, name)
+
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+
+			ret.append((st.st_mtime, st.st_size, path))
+
+		return ret
+
+	def _current_size(self):
+		if self._size == None:
+			self._size = sum(map(lambda x: x[1], self._entries()))
+
+		return self._size
+
+	def _evict(self):
+		if self._current_size() <= self.max_size:
+			return
+
+		# Least recently used entries have the oldest modification time, see
+		# lookup
+		entries = self._entries()
+		entries.sort()
+
+		self._size = sum(map(lambda x: x[1], entries))
+
+		# Evict well below the maximum, so that the directory is not scanned
+		# again for every store
+		low = self.max_size * self.low_water
+
+		for mtime, size, path in entries:
+			if self._size <= low:
+				break
+
+			try:
+				os.unlink(path)
+			except OSError:
+				continue
+
+			self._size -= size
+
+	def key(self, *parts):
+		h = hashlib.sha1()
+
+		for part in parts:
+			if isinstance(part, unicode):
+				part = part.encode('utf-8')
+
+			h.update(str(part))
+			h.update('\0')
+
+		return h.hexdigest()
+
+	def filename(self, key, ext = '.png'):
+		return os.path.join(self.directory, key + ext)
+
+	def lookup(self, key, ext = '.png'):
+		path = self.filename(key, ext)
+
+		counts = self.lookups.setdefault(ext, [0, 0])
+
+		if not os.path.isfile(path):
+			counts[1] += 1
+
+			if ext == '.png':
+				self.misses += 1
+
+			return None
+
+		# Touch the entry so that eviction is least recently used
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+		counts[0] += 1
+
+		if ext == '.png':
+			self.hits += 1
+
+		return path
+
+	def store(self, key, filename, ext = '.png'):
+		if not self._ensure_directory():
+			return None
+
+		path = self.filename(key, ext)
+
+		self.discard(key, ext)
+		size = self._current_size()
+
+		# Move via a temporary file in the cache directory so that other
+		# instances never see a partially written entry
+		fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.')
+		os.close(fd)
+
+		try:
+			shutil.move(filename, tmp)
+			os.rename(tmp, path)
+		except (IOError, OSError):
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+
+			return None
+
+		self._size = size + os.path.getsize(path)
+		self._evict()
+
+		return path
+
+	def store_data(self, key, data, ext = '.png'):
+		if not self._ensure_directory():
+			return None
+
+		fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.')
+
+		try:
+			os.write(fd, data)
+		finally:
+			os.close(fd)
+
+		return self.store(key, tmp, ext)
+
+	def discard(self, key, ext = '.png'):
+		path = self.filename(key, ext)
+
+		if os.path.exists(path):
+			size = os.path.getsize(path)
+			os.unlink(path)
+
+			if self._size != None:
+				self._size -= size
+
+	def stats(self):
+		return {'hits': self.hits,
+		        'misses': self.misses,
+		        'lookups': dict(self.lookups),
+		        'size': self._current_size()}
@@ -0,0 +1,765 @@
+import os
+import sys
+import subprocess
+import tempfile
+import signal
+import shutil
+import heapq
+import multiprocessing
+import time
+import glib
+
+import LatexWorker
+import Constants
+
+def spawn(cmd, callback):
+	null = file('/dev/null')
+
+	# Run in a new process group so that everything started by the shell
+	# can be killed at once
+	proc = subprocess.Popen(cmd, shell=True, stdout=null, stderr=null, preexec_fn=os.setsid)
+
+	def on_child_exit(pid, condition):
+		if os.WIFEXITED(condition):
+			ret = os.WEXITSTATUS(condition)
+		else:
+			ret = -1
+
+		callback(ret)
+
+	# The main loop reaps the child and tells us when it is done, also
+	# when it was killed
+	glib.child_watch_add(proc.pid, on_child_exit)
+	return proc
+
+class LatexTemplate:
+	def __init__(self, filename):
+		self.template = file(filename).read()
+
+		# The part between begin and end document is repeated for every
+		# formula when rendering a batch, each formula ending up on its own
+		# page
+		begin = self.template.find('\\begin{document}')
+		end = self.template.find('\\end{document}')
+
+		if begin != -1 and end > begin:
+			self._static = []
+			self._dynamic = []
+
+			# Split the preamble in a static part which can be precompiled
+			# into a format, and the part with placeholders
+			for line in self.template[0:begin].splitlines(True):
+				if '#color' in line or '#expression' in line:
+					self._dynamic.append(line)
+				else:
+					self._static.append(line)
+
+			self._static = ''.join(self._static)
+			self._dynamic = ''.join(self._dynamic) + '\\begin{document}'
+
+			begin += len('\\begin{document}')
+
+			self._preamble = self.template[0:begin]
+			self._body = self.template[begin:end]
+			self._postamble = self.template[end:]
+		else:
+			self._preamble = None
+
+		self.format = None
+		self._format_proc = None
+		self._format_broken = False
+
+	def supports_batch(self):
+		return self._preamble != None
+
+	def colored_dvi(self):
+		# Without a color in the template, the color is applied when
+		# rasterising the dvi
+		return '#color' in self.template
+
+	def foreground(self, color):
+		if self.colored_dvi():
+			return 'Black'
+		else:
+			return 'rgb %s' % (color.replace(',', ' '),)
+
+	def document(self, expressions, color, precompiled = False):
+		if self._preamble == None:
+			template = self.template.replace('#color', color)
+			return template.replace('#expression', expressions[0])
+
+		body = self._body.replace('#color', color)
+
+		if precompiled:
+			ret = [self._dynamic.replace('#color', color)]
+		else:
+			ret = [self._preamble.replace('#color', color)]
+
+		for expression in expressions:
+			ret.append(body.replace('#expression', expression))
+
+		ret.append(self._postamble.replace('#color', color))
+		return ''.join(ret)
+
+	def latex_command(self, precompiled = False):
+		if precompiled and self.format:
+			directory, name = os.path.split(self.format)
+
+			# Trailing separator keeps the default search path
+			return 'TEXFORMATS="%s:" latex -fmt="%s"' % (directory, name)
+		else:
+			return 'latex'
+
+	def prepare_format(self, cache):
+		if self._preamble == None or self.format or self._format_proc or \
+		   self._format_broken:
+			return
+
+		key = cache.key('format', self._static)
+		filename = cache.lookup(key, '.fmt')
+
+		if filename:
+			self.format = os.path.splitext(filename)[0]
+			return
+
+		# Dump the static part of the preamble into a format in the
+		# background, formulas are rendered without it until it is ready
+		directory = tempfile.mkdtemp(prefix='jft-')
+		file(os.path.join(directory, key + '.tex'), 'w').write(self._static + '\\dump\n')
+
+		def on_done(ret):
+			self._format_proc = None
+			filename = None
+
+			if ret == 0:
+				filename = cache.store(key, os.path.join(directory, key + '.fmt'), '.fmt')
+
+			if filename:
+				self.format = os.path.splitext(filename)[0]
+			else:
+				self._format_broken = True
+
+			shutil.rmtree(directory, True)
+
+		cmd = 'cd "%s" && latex -ini -halt-on-error -interaction=batchmode -jobname="%s" "&latex" "%s.tex"' % (directory, key, key)
+		self._format_proc = spawn(cmd, on_done)
+
+	def format_failed(self):
+		# Rendering without the format worked where rendering with it did
+		# not, so stop using it
+		self.format = None
+		self._format_broken = True
+
+class CancelToken:
+	def __init__(self):
+		self.cancelled = False
+		self._callbacks = []
+
+	def connect(self, callback):
+		if self.cancelled:
+			callback()
+		else:
+			self._callbacks.append(callback)
+
+	def cancel(self):
+		if self.cancelled:
+			return
+
+		self.cancelled = True
+
+		for callback in self._callbacks:
+			callback()
+
+		self._callbacks = []
+
+class LatexJob:
+	def __init__(self, template, expressions, color, dpi, precompiled, callback):
+		self.directory = tempfile.mkdtemp(prefix='jft-')
+		self.name = os.path.join(self.directory, 'formula')
+		self.size = len(expressions)
+		self.expressions = expressions
+		self.dvi_key = None
+
+		self.precompiled = precompiled and template.format != None
+		self.started = time.time()
+
+		file(self.name + '.tex', 'w').write(template.document(expressions, color, self.precompiled))
+
+		cmd = LatexWorker.render_command(self.directory,
+		                                 template.latex_command(self.precompiled),
+		                                 dpi,
+		                                 template.foreground(color))
+
+		self.proc = spawn(cmd, lambda ret: callback(self, ret))
+
+	def page(self, idx):
+		try:
+			return file('%s%d.png' % (self.name, idx + 1)).read()
+		except IOError:
+			return None
+
+	def dvi(self):
+		try:
+			return file(self.name + '.dvi').read()
+		except IOError:
+			return None
+
+	def log(self):
+		try:
+			return file(self.name + '.log').read()
+		except IOError:
+			return None
+
+	def kill(self):
+		try:
+			os.killpg(self.proc.pid, signal.SIGTERM)
+		except OSError:
+			pass
+
+	def cleanup(self):
+		shutil.rmtree(self.directory, True)
+
+class WorkerJob:
+	def __init__(self, worker, template, expressions, color, dpi, precompiled, callback):
+		self.size = len(expressions)
+		self.expressions = expressions
+		self.dvi_key = None
+
+		self.precompiled = precompiled and template.format != None
+		self.started = time.time()
+
+		self._pages = []
+		self._dvi = None
+		self._log = None
+		self._callback = callback
+		self._worker = worker
+
+		worker.submit(self, {'document': template.document(expressions, color, self.precompiled),
+		                     'latex': template.latex_command(self.precompiled),
+		                     'dpi': dpi,
+		                     'fg': template.foreground(color),
+		                     'size': self.size})
+
+	def done(self, ret, pages, dvi = None, log = None):
+		self._pages = pages
+		self._dvi = dvi
+		self._log = log
+		self._callback(self, ret)
+
+	def page(self, idx):
+		if idx < len(self._pages):
+			return self._pages[idx]
+		else:
+			return None
+
+	def dvi(self):
+		return self._dvi
+
+	def log(self):
+		return self._log
+
+	def kill(self):
+		self._worker.cancel(self)
+
+	def cleanup(self):
+		self._pages = []
+		self._dvi = None
+		self._log = None
+
+class RasterJob:
+	def __init__(self, dvis, dpi, fg, callback):
+		# Rasterise pages of already compiled dvi files, given as a list of
+		# (filename, [pages]), in a single run
+		self.directory = tempfile.mkdtemp(prefix='jft-')
+
+		cmds = []
+
+		for i in range(len(dvis)):
+			filename, pages = dvis[i]
+			cmds.append(LatexWorker.dvipng_command('dvi%d-%%d.png' % (i,), dpi, fg, filename, pages))
+
+		cmd = 'cd "%s" && %s' % (self.directory, ' ; '.join(cmds))
+		self.proc = spawn(cmd, lambda ret: callback(self, ret))
+
+	def page(self, idx, page):
+		try:
+			return file(os.path.join(self.directory, 'dvi%d-%d.png' % (idx, page + 1))).read()
+		except IOError:
+			return None
+
+	def kill(self):
+		try:
+			os.killpg(self.proc.pid, signal.SIGTERM)
+		except OSError:
+			pass
+
+	def cleanup(self):
+		shutil.rmtree(self.directory, True)
+
+class WorkerClient:
+	instance = None
+
+	def __init__(self):
+		self._proc = None
+		self._watch_id = 0
+		self._data = ''
+
+		self._jobs = {}
+		self._messages = {}
+		self._next_id = 0
+
+		self._refcount = 0
+		self._restarts = []
+
+		self._ready = False
+		self._broken = False
+
+	@staticmethod
+	def default():
+		if WorkerClient.instance == None:
+			WorkerClient.instance = WorkerClient()
+
+		return WorkerClient.instance
+
+	def acquire(self):
+		self._refcount += 1
+
+	def release(self):
+		self._refcount -= 1
+
+		if self._refcount == 0:
+			self._stop()
+
+	def available(self):
+		if self._refcount == 0 or not Constants.LATEX_WORKER or self._broken:
+			return False
+
+		# Give up when the worker keeps crashing
+		now = time.time()
+		self._restarts = filter(lambda x: now - x < 60, self._restarts)
+
+		if len(self._restarts) >= 5:
+			return False
+
+		# Start it here, so that a worker which cannot be started is not
+		# used at all
+		return self._proc != None or self._start()
+
+	def _interpreter(self):
+		# The worker needs the python the plugin runs in. Inside gedit
+		# sys.executable is not a python binary
+		if os.path.basename(sys.executable).startswith('python'):
+			return sys.executable
+		else:
+			return 'python%d.%d' % sys.version_info[0:2]
+
+	def _start(self):
+		script = os.path.join(os.path.dirname(__file__), 'LatexWorker.py')
+
+		try:
+			self._proc = subprocess.Popen([self._interpreter(), script],
+			                              stdin=subprocess.PIPE,
+			                              stdout=subprocess.PIPE,
+			                              close_fds=True)
+		except OSError:
+			self._broken = True
+			return False
+
+		self._data = ''
+		self._ready = False
+		self._watch_id = glib.io_add_watch(self._proc.stdout,
+		                                   glib.IO_IN | glib.IO_HUP | glib.IO_ERR,
+		                                   self._on_output)
+
+		glib.child_watch_add(self._proc.pid, self._on_exit, self._proc)
+		return True
+
+	def _stop(self):
+		if not self._proc:
+			return
+
+		proc = self._proc
+		self._proc = None
+
+		if self._watch_id != 0:
+			glib.source_remove(self._watch_id)
+			self._watch_id = 0
+
+		# The worker exits when its input is closed
+		proc.stdin.close()
+		proc.stdout.close()
+
+		self._jobs = {}
+		self._messages = {}
+
+	def _send(self, message):
+		try:
+			self._proc.stdin.write(LatexWorker.encode(message))
+			self._proc.stdin.flush()
+		except IOError:
+			# Picked up by _on_exit
+			pass
+
+	def submit(self, job, message):
+		if not self._proc:
+			self._start()
+
+		self._next_id += 1
+
+		message['id'] = self._next_id
+		self._jobs[self._next_id] = job
+		self._messages[self._next_id] = message
+
+		self._send(message)
+
+	def cancel(self, job):
+		for jobid in self._jobs:
+			if self._jobs[jobid] == job:
+				del self._jobs[jobid]
+				del self._messages[jobid]
+
+				self._send({'cancel': jobid})
+				break
+
+	def _on_output(self, source, condition):
+		data = ''
+
+		if condition & glib.IO_IN:
+			data = os.read(source.fileno(), 65536)
+
+		if not data:
+			self._watch_id = 0
+			return False
+
+		messages, self._data = LatexWorker.decode(self._data + data)
+
+		for message in messages:
+			if 'ready' in message:
+				self._ready = True
+				continue
+
+			jobid = message['id']
+
+			if jobid in self._jobs:
+				job = self._jobs[jobid]
+
+				del self._jobs[jobid]
+				del self._messages[jobid]
+
+				job.done(message['ret'], message['pages'], message['dvi'], message['log'])
+
+		return True
+
+	def _on_exit(self, pid, condition, proc):
+		if proc != self._proc:
+			# Shut down on purpose
+			return
+
+		if self._watch_id != 0:
+			glib.source_remove(self._watch_id)
+			self._watch_id = 0
+
+		self._proc = None
+		self._restarts.append(time.time())
+
+		# A worker which exits before it is ready will never start, for
+		# example when the interpreter cannot import it
+		if not self._ready:
+			self._broken = True
+
+		# Restart and resend everything which was still running
+		jobs = self._jobs
+		messages = self._messages
+
+		self._jobs = {}
+		self._messages = {}
+
+		for jobid in sorted(jobs.keys()):
+			if self.available():
+				self.submit(jobs[jobid], messages[jobid])
+			else:
+				jobs[jobid].done(-1, [])
+
+class RenderRequest:
+	def __init__(self, owner, bounds, text, key, color, dpi):
+		self.owner = owner
+		self.bounds = bounds
+		self.text = text
+		self.key = key
+		self.color = color
+		self.dpi = dpi
+
+		self.priority = 0
+		self.isolated = False
+		self.precompiled = True
+		self.cancelled = False
+		self.seq = 0
+
+		self.job = None
+		self.page = 0
+
+		self.token = CancelToken()
+		self.token.connect(self._on_cancel)
+
+		self.queue = None
+
+	def _on_cancel(self):
+		if self.queue:
+			self.queue.cancel(self)
+
+	def compatible(self, other):
+		return not other.isolated and \
+		       other.precompiled == self.precompiled and \
+		       self.owner == other.owner and \
+		       self.color == other.color and \
+		       self.dpi == other.dpi
+
+class RenderQueue:
+	instance = None
+
+	def __init__(self, max_running = None, batch_size = None):
+		if max_running == None:
+			max_running = Constants.LATEX_MAX_RUNNING
+
+		if batch_size == None:
+			batch_size = Constants.LATEX_BATCH_SIZE
+
+		if max_running == None:
+			try:
+				max_running = multiprocessing.cpu_count()
+			except NotImplementedError:
+				max_running = 1
+
+		self.max_running = max_running
+		self.batch_size = batch_size
+
+		self._queue = []
+		self._pending = 0
+		self._running = {}
+		self._seq = 0
+
+		self._dispatch_id = 0
+
+		# Number of formulas and total time rendering them, with and without
+		# a precompiled format
+		self._timings = {True: [0, 0.0], False: [0, 0.0]}
+
+	@staticmethod
+	def default():
+		if RenderQueue.instance == None:
+			RenderQueue.instance = RenderQueue()
+
+		return RenderQueue.instance
+
+	def depth(self):
+		return self._pending
+
+	def running(self):
+		return len(self._running)
+
+	def stats(self):
+		ret = {'pending': self._pending,
+		       'running': len(self._running),
+		       'max_running': self.max_running}
+
+		for precompiled, name in ((True, 'precompiled'), (False, 'plain')):
+			num, total = self._timings[precompiled]
+
+			ret[name + '_formulas'] = num
+
+			if num > 0:
+				ret[name + '_time'] = total / num
+			else:
+				ret[name + '_time'] = None
+
+		return ret
+
+	def _push(self, request):
+		self._seq += 1
+		request.seq = self._seq
+
+		heapq.heappush(self._queue, (request.priority, request.seq, request))
+
+	def _queued(self, item):
+		# Cancelled requests are left in the queue and skipped, and
+		# resubmitted requests have a newer entry
+		return not item[2].cancelled and item[2].seq == item[1]
+
+	def _queue_dispatch(self):
+		if self._dispatch_id == 0:
+			self._dispatch_id = glib.idle_add(self._dispatch)
+
+	def submit(self, request):
+		if request.token.cancelled:
+			return
+
+		request.queue = self
+		request.priority = request.owner.priority(request.bounds)
+		request.cancelled = False
+
+		self._push(request)
+		self._pending += 1
+
+		self._queue_dispatch()
+
+	def cancel(self, request):
+		if request.cancelled:
+			return
+
+		request.cancelled = True
+		job = request.job
+
+		if job == None:
+			# Still queued, it will be skipped when it comes up
+			self._pending -= 1
+			return
+
+		requests = self._running[job]
+		requests.remove(request)
+
+		# Only kill the job when no other formula is waiting for it
+		if not requests:
+			del self._running[job]
+
+			job.kill()
+			job.cleanup()
+
+			self._queue_dispatch()
+
+	def cancel_offscreen(self, owner, distance):
+		ret = []
+
+		for item in self._queue:
+			request = item[2]
+
+			if self._queued(item) and request.owner == owner and \
+			   request.owner.priority(request.bounds) > distance:
+				self.cancel(request)
+				ret.append(request)
+
+		return ret
+
+	def reprioritise(self, owner = None):
+		queue = []
+
+		for item in self._queue:
+			if not self._queued(item):
+				continue
+
+			priority, seq, request = item
+
+			if owner == None or request.owner == owner:
+				priority = request.owner.priority(request.bounds)
+				request.priority = priority
+
+			queue.append((priority, seq, request))
+
+		heapq.heapify(queue)
+		self._queue = queue
+
+	def _pop(self):
+		while self._queue:
+			item = heapq.heappop(self._queue)
+
+			if self._queued(item):
+				self._pending -= 1
+				return item[2]
+
+		return None
+
+	def _collect_batch(self, request):
+		batch = [request]
+
+		if request.isolated or not request.owner.template.supports_batch():
+			return batch
+
+		# Take the next most important formulas that can be rendered in
+		# the same run
+		rest = []
+
+		while self._queue and len(batch) < self.batch_size:
+			item = heapq.heappop(self._queue)
+
+			if not self._queued(item):
+				continue
+
+			if request.compatible(item[2]):
+				batch.append(item[2])
+				self._pending -= 1
+			else:
+				rest.append(item)
+
+		for item in rest:
+			heapq.heappush(self._queue, item)
+
+		return batch
+
+	def _dispatch(self):
+		self._dispatch_id = 0
+
+		while len(self._running) < self.max_running:
+			request = self._pop()
+
+			if request == None:
+				break
+
+			batch = self._collect_batch(request)
+			args = (request.owner.template,
+			        map(lambda x: x.text, batch),
+			        request.color,
+			        request.dpi,
+			        request.precompiled,
+			        self._job_done)
+
+			worker = WorkerClient.default()
+
+			# The worker hands back the images directly, see
+			# Constants.LATEX_WORKER
+			if worker.available():
+				job = WorkerJob(worker, *args)
+			else:
+				job = LatexJob(*args)
+
+			for i in range(len(batch)):
+				batch[i].job = job
+				batch[i].page = i
+
+			self._running[job] = batch
+
+		return False
+
+	def _job_done(self, job, ret):
+		if not job in self._running:
+			# Cancelled, nothing left to do after reaping the child
+			return
+
+		requests = self._running[job]
+		del self._running[job]
+
+		if ret == 0:
+			timing = self._timings[job.precompiled]
+
+			timing[0] += job.size
+			timing[1] += time.time() - job.started
+
+		for request in requests:
+			request.job = None
+
+			if ret == 0:
+				if not request.precompiled:
+					request.owner.template.format_failed()
+
+				request.owner.render_done(request, job.page(request.page), job)
+			elif job.size > 1:
+				# Isolate the formula(s) that failed by rendering them alone
+				request.isolated = True
+				self.submit(request)
+			elif job.precompiled:
+				# Make sure it is not the format which is broken
+				request.precompiled = False
+				self.submit(request)
+			else:
+				request.owner.render_done(request, None, job)
+
+		job.cleanup()
+		self._queue_dispatch()
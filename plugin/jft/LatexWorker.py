@@ -0,0 +1,177 @@
+import os
+import sys
+import struct
+import cPickle
+import tempfile
+import shutil
+import signal
+import subprocess
+import threading
+
+# Messages between the plugin and the worker are pickled objects, prefixed
+# with their length
+HEADER = struct.Struct('!I')
+
+def encode(message):
+	data = cPickle.dumps(message, 2)
+	return HEADER.pack(len(data)) + data
+
+def decode(data):
+	# Returns the decoded messages and the remaining data
+	ret = []
+
+	while len(data) >= HEADER.size:
+		size = HEADER.unpack(data[0:HEADER.size])[0]
+
+		if len(data) < HEADER.size + size:
+			break
+
+		ret.append(cPickle.loads(data[HEADER.size:HEADER.size + size]))
+		data = data[HEADER.size + size:]
+
+	return ret, data
+
+def dvipng_command(output, dpi, fg, filename, pages = None):
+	if pages:
+		pages = '-pp %s ' % (','.join(map(lambda x: str(x + 1), pages)),)
+	else:
+		pages = ''
+
+	return 'dvipng -o "%s" -T tight -D %f -bg Transparent -fg "%s" %s"%s"' % (output, dpi, fg, pages, filename)
+
+def render_command(directory, latex, dpi, fg):
+	# Run latex once, and dvipng once over all the pages
+	return 'cd "%s" && %s -halt-on-error -interaction=batchmode formula.tex && %s' % (directory, latex, dvipng_command('formula%d.png', dpi, fg, 'formula.dvi'))
+
+class Worker:
+	def __init__(self, infile, outfile):
+		self._in = infile
+		self._out = outfile
+
+		self._lock = threading.Lock()
+		self._procs = {}
+		self._threads = []
+		self._stopping = False
+
+		self.directory = tempfile.mkdtemp(prefix='jft-worker-')
+
+	def _send(self, message):
+		self._lock.acquire()
+
+		try:
+			self._out.write(encode(message))
+			self._out.flush()
+		finally:
+			self._lock.release()
+
+	def _render(self, job):
+		directory = os.path.join(self.directory, str(job['id']))
+		os.mkdir(directory)
+
+		try:
+			file(os.path.join(directory, 'formula.tex'), 'w').write(job['document'])
+
+			null = file('/dev/null', 'w')
+			proc = subprocess.Popen(render_command(directory, job['latex'], job['dpi'], job['fg']),
+			                        shell=True,
+			                        stdout=null,
+			                        stderr=null,
+			                        preexec_fn=os.setsid)
+
+			self._lock.acquire()
+			self._procs[job['id']] = proc
+			stopping = self._stopping
+			self._lock.release()
+
+			if stopping:
+				self._cancel(job['id'])
+
+			ret = proc.wait()
+
+			self._lock.acquire()
+			cancelled = not job['id'] in self._procs
+			self._procs.pop(job['id'], None)
+			self._lock.release()
+
+			if cancelled:
+				return
+
+			pages = []
+			dvi = None
+			log = None
+
+			if ret == 0:
+				for i in range(job['size']):
+					try:
+						pages.append(file(os.path.join(directory, 'formula%d.png' % (i + 1,))).read())
+					except IOError:
+						pages.append(None)
+
+				try:
+					dvi = file(os.path.join(directory, 'formula.dvi')).read()
+				except IOError:
+					pass
+			else:
+				try:
+					log = file(os.path.join(directory, 'formula.log')).read()
+				except IOError:
+					pass
+
+			self._send({'id': job['id'], 'ret': ret, 'pages': pages, 'dvi': dvi, 'log': log})
+		finally:
+			shutil.rmtree(directory, True)
+
+	def _cancel(self, jobid):
+		self._lock.acquire()
+		proc = self._procs.pop(jobid, None)
+		self._lock.release()
+
+		if proc:
+			try:
+				os.killpg(proc.pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+	def run(self):
+		data = ''
+
+		# Tells the plugin that the worker started
+		self._send({'ready': True})
+
+		while True:
+			chunk = os.read(self._in.fileno(), 65536)
+
+			# The plugin closes the pipe to shut us down
+			if not chunk:
+				break
+
+			messages, data = decode(data + chunk)
+
+			for message in messages:
+				if 'cancel' in message:
+					self._cancel(message['cancel'])
+				else:
+					self._threads = filter(lambda x: x.isAlive(), self._threads)
+
+					thread = threading.Thread(target=self._render, args=(message,))
+					thread.start()
+
+					self._threads.append(thread)
+
+		self._lock.acquire()
+		self._stopping = True
+		self._lock.release()
+
+		for jobid in list(self._procs.keys()):
+			self._cancel(jobid)
+
+		for thread in self._threads:
+			thread.join()
+
+		shutil.rmtree(self.directory, True)
+
+def main():
+	Worker(sys.stdin, sys.stdout).run()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,366 @@
+import random
+
+class LineIndex:
+	"""Entries ordered by line number
+
+	The entries are kept in a treap keyed by line. Shifting the lines of all
+	entries after an edit only touches the nodes on a single path, the shift
+	is stored on the subtree and pushed down to the children when they are
+	visited.
+
+	Entries can span several lines. Every node keeps the last line reached
+	by any entry in its subtree, which makes it an interval tree for finding
+	the entries containing a line.
+	"""
+
+	class Node(object):
+		__slots__ = ('line', 'span', 'reach', 'priority', 'delta', 'left', 'right', 'parent')
+
+		def __init__(self):
+			self.line = 0
+			self.span = 0
+			self.reach = 0
+			self.priority = 0
+			self.delta = 0
+			self.left = None
+			self.right = None
+			self.parent = None
+
+	def __init__(self):
+		self._root = None
+		self._size = 0
+
+	def __len__(self):
+		return self._size
+
+	def __iter__(self):
+		return iter(self._nodes(self._root))
+
+	def _push(self, node):
+		# Apply a pending shift to the children
+		if node.delta == 0:
+			return
+
+		for child in (node.left, node.right):
+			if child != None:
+				child.line += node.delta
+				child.reach += node.delta
+				child.delta += node.delta
+
+		node.delta = 0
+
+	def _update(self, node):
+		# Children must have been pushed to
+		node.reach = node.line + node.span
+
+		for child in (node.left, node.right):
+			if child != None and child.reach > node.reach:
+				node.reach = child.reach
+
+	def _shift_node(self, node, diff):
+		node.line += diff
+		node.reach += diff
+		node.delta += diff
+
+	def _split(self, node, line):
+		# Splits into the nodes before line, and the nodes at or after line
+		if node == None:
+			return None, None
+
+		self._push(node)
+
+		if node.line < line:
+			left, right = self._split(node.right, line)
+			node.right = left
+
+			if left != None:
+				left.parent = node
+
+			self._update(node)
+			return node, right
+		else:
+			left, right = self._split(node.left, line)
+			node.left = right
+
+			if right != None:
+				right.parent = node
+
+			self._update(node)
+			return left, node
+
+	def _merge(self, left, right):
+		if left == None:
+			return right
+
+		if right == None:
+			return left
+
+		if left.priority > right.priority:
+			self._push(left)
+
+			left.right = self._merge(left.right, right)
+			left.right.parent = left
+
+			self._update(left)
+			return left
+		else:
+			self._push(right)
+
+			right.left = self._merge(left, right.left)
+			right.left.parent = right
+
+			self._update(right)
+			return right
+
+	def _set_root(self, node):
+		self._root = node
+
+		if node != None:
+			node.parent = None
+
+	def _nodes(self, node):
+		ret = []
+		self._collect(node, None, None, ret)
+
+		return ret
+
+	def _collect(self, node, first, last, ret):
+		if node == None:
+			return
+
+		self._push(node)
+
+		if first == None or node.line >= first:
+			self._collect(node.left, first, last, ret)
+
+		if (first == None or node.line >= first) and \
+		   (last == None or node.line <= last):
+			ret.append(node)
+
+		if last == None or node.line <= last:
+			self._collect(node.right, first, last, ret)
+
+	def _collect_containing(self, node, line, ret):
+		# Nothing in this subtree reaches the line
+		if node == None or node.reach < line:
+			return
+
+		self._push(node)
+		self._collect_containing(node.left, line, ret)
+
+		if node.line <= line:
+			if node.line + node.span >= line:
+				ret.append(node)
+
+			self._collect_containing(node.right, line, ret)
+
+	def _update_subtree(self, node):
+		if node == None:
+			return
+
+		self._push(node)
+
+		self._update_subtree(node.left)
+		self._update_subtree(node.right)
+
+		self._update(node)
+
+	def _update_path(self, node):
+		while node != None:
+			self._update(node)
+			node = node.parent
+
+	def contains(self, node):
+		return node.parent != None or node == self._root
+
+	def line(self, node):
+		"""line(node) -> line of the node, including pending shifts"""
+
+		ret = node.line
+		parent = node.parent
+
+		while parent != None:
+			ret += parent.delta
+			parent = parent.parent
+
+		return ret
+
+	def insert(self, node, line, span = 0):
+		node.line = line
+		node.span = span
+		node.reach = line + span
+		node.priority = random.random()
+		node.delta = 0
+		node.left = None
+		node.right = None
+
+		# Nodes on the same line keep their insertion order
+		left, right = self._split(self._root, line + 1)
+
+		self._set_root(self._merge(self._merge(left, node), right))
+		self._size += 1
+
+	def remove(self, node):
+		if not self.contains(node):
+			return False
+
+		# Push pending shifts down the path to the node first
+		path = []
+		parent = node.parent
+
+		while parent != None:
+			path.append(parent)
+			parent = parent.parent
+
+		for parent in reversed(path):
+			self._push(parent)
+
+		self._push(node)
+
+		child = self._merge(node.left, node.right)
+		parent = node.parent
+
+		if parent == None:
+			self._set_root(child)
+		else:
+			if parent.left == node:
+				parent.left = child
+			else:
+				parent.right = child
+
+			if child != None:
+				child.parent = parent
+
+			self._update_path(parent)
+
+		node.left = None
+		node.right = None
+		node.parent = None
+
+		self._size -= 1
+		return True
+
+	def before(self, line):
+		"""before(line) -> last node at or before line, or None"""
+
+		ret = None
+		node = self._root
+
+		while node != None:
+			self._push(node)
+
+			if node.line <= line:
+				ret = node
+				node = node.right
+			else:
+				node = node.left
+
+		return ret
+
+	def after(self, line):
+		"""after(line) -> first node at or after line, or None"""
+
+		ret = None
+		node = self._root
+
+		while node != None:
+			self._push(node)
+
+			if node.line >= line:
+				ret = node
+				node = node.left
+			else:
+				node = node.right
+
+		return ret
+
+	def at_line(self, line):
+		return self.between(line, line)
+
+	def between(self, first, last):
+		"""between(first, last) -> nodes from line first up to and including last"""
+
+		ret = []
+		self._collect(self._root, first, last, ret)
+
+		return ret
+
+	def containing(self, line):
+		"""containing(line) -> nodes starting at or before line and reaching it"""
+
+		ret = []
+		self._collect_containing(self._root, line, ret)
+
+		return ret
+
+	def _resize(self, line, resize):
+		# Changes the span of nodes starting before line and reaching it
+		nodes = filter(lambda x: x.line < line, self.containing(line))
+
+		for node in nodes:
+			node.span = resize(node)
+
+		for node in nodes:
+			self._update_path(node)
+
+	def shift(self, line, diff):
+		"""shift(line, diff) -> None
+
+		Moves all nodes at or after line by diff lines, nodes spanning the line
+		grow. Moving them before other nodes is not allowed, see join for
+		removing lines.
+		"""
+
+		self._resize(line, lambda x: x.span + diff)
+
+		left, right = self._split(self._root, line)
+
+		if right != None:
+			self._shift_node(right, diff)
+
+		self._set_root(self._merge(left, right))
+
+	def join(self, first, last):
+		"""join(first, last) -> None
+
+		Lines after first, up to and including last, were removed. Their nodes
+		end up on line first, and the nodes after them move up.
+		"""
+
+		if last <= first:
+			return
+
+		diff = last - first
+
+		def end(x):
+			x = x.line + x.span
+
+			if x <= last:
+				return min(x, first)
+			else:
+				return x - diff
+
+		self._resize(first + 1, lambda x: end(x) - x.line)
+
+		left, right = self._split(self._root, first + 1)
+		middle, right = self._split(right, last + 1)
+
+		for node in self._nodes(middle):
+			node.span = end(node) - first
+			node.line = first
+
+		self._update_subtree(middle)
+
+		if right != None:
+			self._shift_node(right, -diff)
+
+		self._set_root(self._merge(self._merge(left, middle), right))
+
+	def clear(self):
+		for node in self:
+			node.left = None
+			node.right = None
+			node.parent = None
+
+		self._root = None
+		self._size = 0
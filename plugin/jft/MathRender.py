@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import StringIO
+import cairo
+import pangocairo
+from gtk import gdk
+import glib
+
+class MathRender:
+	# Lower case greek is italic in TeX, upper case is upright
+	greek = {
+		'alpha': u'α', 'beta': u'β', 'gamma': u'γ', 'delta': u'δ',
+		'epsilon': u'ϵ', 'varepsilon': u'ε', 'zeta': u'ζ', 'eta': u'η',
+		'theta': u'θ', 'vartheta': u'ϑ', 'iota': u'ι', 'kappa': u'κ',
+		'lambda': u'λ', 'mu': u'μ', 'nu': u'ν', 'xi': u'ξ', 'pi': u'π',
+		'varpi': u'ϖ', 'rho': u'ρ', 'varrho': u'ϱ', 'sigma': u'σ',
+		'varsigma': u'ς', 'tau': u'τ', 'upsilon': u'υ', 'phi': u'ϕ',
+		'varphi': u'φ', 'chi': u'χ', 'psi': u'ψ', 'omega': u'ω'
+	}
+
+	upper_greek = {
+		'Gamma': u'Γ', 'Delta': u'Δ', 'Theta': u'Θ', 'Lambda': u'Λ',
+		'Xi': u'Ξ', 'Pi': u'Π', 'Sigma': u'Σ', 'Upsilon': u'Υ',
+		'Phi': u'Φ', 'Psi': u'Ψ', 'Omega': u'Ω'
+	}
+
+	symbols = {
+		'infty': u'∞', 'partial': u'∂', 'nabla': u'∇', 'forall': u'∀',
+		'exists': u'∃', 'ldots': u'…', 'cdots': u'⋯', 'prime': u'′'
+	}
+
+	binary = {
+		'+': u'+', '-': u'−', 'cdot': u'⋅', 'times': u'×', 'pm': u'±',
+		'mp': u'∓', 'cup': u'∪', 'cap': u'∩'
+	}
+
+	relations = {
+		'=': u'=', '<': u'<', '>': u'>', 'leq': u'≤', 'le': u'≤',
+		'geq': u'≥', 'ge': u'≥', 'neq': u'≠', 'ne': u'≠', 'approx': u'≈',
+		'equiv': u'≡', 'sim': u'∼', 'to': u'→', 'rightarrow': u'→',
+		'leftarrow': u'←', 'in': u'∈', 'notin': u'∉', 'subset': u'⊂',
+		'subseteq': u'⊆'
+	}
+
+	punctuation = '()[],.;:/|!\''
+
+	def __init__(self):
+		self._text = u''
+		self._pos = 0
+
+	def _peek(self):
+		if self._pos < len(self._text):
+			return self._text[self._pos]
+		else:
+			return None
+
+	def _skip_space(self):
+		while self._peek() != None and self._peek().isspace():
+			self._pos += 1
+
+	def _command(self):
+		start = self._pos
+
+		while self._peek() != None and self._peek().isalpha():
+			self._pos += 1
+
+		return self._text[start:self._pos]
+
+	def _escape(self, s):
+		return glib.markup_escape_text(s.encode('utf-8')).decode('utf-8')
+
+	def _base(self):
+		self._skip_space()
+		c = self._peek()
+
+		if c == None:
+			return None
+
+		self._pos += 1
+
+		if c == '{':
+			ret = self._expression()
+
+			if ret == None or self._peek() != '}':
+				return None
+
+			self._pos += 1
+			return ret.strip()
+		elif c.isalpha() and ord(c) < 128:
+			return u'<i>%s</i>' % (c,)
+		elif c.isdigit():
+			ret = c
+
+			while self._peek() != None and (self._peek().isdigit() or self._peek() == '.'):
+				ret += self._peek()
+				self._pos += 1
+
+			return ret
+		elif c in MathRender.binary:
+			return u' %s ' % (self._escape(MathRender.binary[c]),)
+		elif c in MathRender.relations:
+			return u' %s ' % (self._escape(MathRender.relations[c]),)
+		elif c in MathRender.punctuation:
+			return self._escape(c)
+		elif c == '\\':
+			name = self._command()
+
+			if name in MathRender.greek:
+				return u'<i>%s</i>' % (MathRender.greek[name],)
+			elif name in MathRender.upper_greek:
+				return MathRender.upper_greek[name]
+			elif name in MathRender.symbols:
+				return MathRender.symbols[name]
+			elif name in MathRender.binary:
+				return u' %s ' % (MathRender.binary[name],)
+			elif name in MathRender.relations:
+				return u' %s ' % (MathRender.relations[name],)
+
+		return None
+
+	def _atom(self):
+		ret = self._base()
+
+		if ret == None:
+			return None
+
+		while True:
+			self._skip_space()
+			c = self._peek()
+
+			if c != '_' and c != '^':
+				return ret
+
+			self._pos += 1
+
+			# A script is a single token or a group
+			self._skip_space()
+
+			if self._peek() != '{' and self._peek() != '\\' and self._peek() != None:
+				arg = self._base_single()
+			else:
+				arg = self._base()
+
+			if arg == None:
+				return None
+
+			if c == '_':
+				ret += u'<sub>%s</sub>' % (arg,)
+			else:
+				ret += u'<sup>%s</sup>' % (arg,)
+
+	def _base_single(self):
+		# In x^23 only the 2 is the superscript
+		c = self._peek()
+
+		if c.isdigit():
+			self._pos += 1
+			return c
+		else:
+			return self._base()
+
+	def _expression(self):
+		ret = []
+
+		while True:
+			self._skip_space()
+			c = self._peek()
+
+			if c == None or c == '}':
+				return u''.join(ret)
+
+			atom = self._atom()
+
+			if atom == None:
+				return None
+
+			ret.append(atom)
+
+	def markup(self, expression):
+		"""markup(expression) -> pango markup or None
+
+		Converts a simple math expression into pango markup. Returns None if
+		the expression uses anything outside of the supported subset.
+		"""
+
+		if isinstance(expression, str):
+			expression = expression.decode('utf-8')
+
+		self._text = expression
+		self._pos = 0
+
+		ret = self._expression()
+
+		if ret == None or self._pos != len(self._text):
+			return None
+
+		ret = ret.strip()
+
+		if not ret:
+			return None
+
+		return ret.encode('utf-8')
+
+	def render(self, expression, color, font):
+		"""render(expression, color, font) -> gdk.Pixbuf or None
+
+		Renders a simple math expression using the (r, g, b) color and pango
+		font description. Returns None if the expression is not supported.
+		"""
+
+		markup = self.markup(expression)
+
+		if markup == None:
+			return None
+
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+		ctx = pangocairo.CairoContext(cairo.Context(surface))
+
+		layout = ctx.create_layout()
+		layout.set_font_description(font)
+		layout.set_markup(markup)
+
+		width, height = layout.get_pixel_size()
+
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, max(width, 1), max(height, 1))
+		ctx = pangocairo.CairoContext(cairo.Context(surface))
+
+		ctx.set_source_rgb(*color)
+		ctx.update_layout(layout)
+		ctx.show_layout(layout)
+
+		data = StringIO.StringIO()
+		surface.write_to_png(data)
+
+		loader = gdk.PixbufLoader('png')
+		loader.write(data.getvalue())
+		loader.close()
+
+		return loader.get_pixbuf()
@@ -0,0 +1,68 @@
+import re
+
+class Scanner:
+	"""Finds the matches of all validators on a line in one pass
+
+	Validators which declare the characters their matches start with are only
+	tried at the positions of those characters, which are found in a single
+	pass over the line. Other validators are always run on the whole line.
+	"""
+
+	def __init__(self, validators):
+		self._validators = validators
+		self._keyed = {}
+
+		for i, validator in enumerate(validators):
+			if validator.first_chars != None:
+				for c in validator.first_chars:
+					self._keyed.setdefault(c, []).append((i, validator.matcher()))
+
+		if self._keyed:
+			self._re_first = re.compile('[%s]' % (''.join(map(re.escape, self._keyed.keys())),))
+		else:
+			self._re_first = None
+
+	def scan(self, line):
+		"""scan(line) -> list of (validator, match)
+
+		The matches of each validator are the same as those of its match
+		method, grouped per validator in the order of the validators.
+		"""
+
+		found = None
+
+		if self._re_first != None:
+			keyed = self._keyed
+			ends = [0] * len(self._validators)
+
+			for m in self._re_first.finditer(line):
+				pos = m.start()
+
+				for i, matcher in keyed[line[pos]]:
+					# Matches of a validator do not overlap, like with finditer
+					if ends[i] > pos:
+						continue
+
+					match = matcher(line, pos)
+
+					if match:
+						if found == None:
+							found = [[] for v in self._validators]
+
+						found[i].append(match)
+						ends[i] = max(match.end(0), pos + 1)
+
+		ret = []
+
+		for i, validator in enumerate(self._validators):
+			if validator.first_chars == None:
+				matches = validator.match(line)
+			elif found != None:
+				matches = found[i]
+			else:
+				continue
+
+			for match in matches:
+				ret.append((validator, match))
+
+		return ret
@@ -0,0 +1,216 @@
+from Signals import Signals
+from BufferUtils import BufferUtils
+from LineIndex import LineIndex
+from DirtyRanges import DirtyRanges
+import Constants
+
+class Structure(Signals):
+	"""Kind of every line in a buffer
+
+	Lines are list items, headers, comments, blank lines or text. The lines
+	of each kind but text are kept in a LineIndex, next to an index of the
+	lines at which looking back for a list item stops. Edits only mark lines
+	as dirty, a query classifies the dirty lines it looks at.
+	"""
+
+	kinds = ('item', 'header', 'comment', 'blank')
+
+	class Line(LineIndex.Node):
+		__slots__ = ('kind', 'indent', 'bullet', 'tag')
+
+		def __init__(self, kind, indent, bullet = None, tag = None):
+			LineIndex.Node.__init__(self)
+
+			self.kind = kind
+			self.indent = indent
+			self.bullet = bullet
+			self.tag = tag
+
+	def __init__(self, buf, re_list, re_tag):
+		Signals.__init__(self)
+
+		buf.set_data(Constants.STRUCTURE_KEY, self)
+
+		self._buffer = BufferUtils(buf)
+		self._refcount = 0
+		self._re_list = re_list
+		self._re_tag = re_tag
+
+		self._indexes = {}
+
+		for kind in Structure.kinds:
+			self._indexes[kind] = LineIndex()
+
+		# Blank lines and lines which are not indented
+		self._stops = LineIndex()
+
+		self._dirty = DirtyRanges()
+		self._dirty.add(0, buf.get_line_count())
+
+		# Before the default handlers, the lines are those of the edit
+		self.connect_signal(buf, 'insert-text', self.on_insert_text)
+		self.connect_signal(buf, 'delete-range', self.on_delete_range)
+
+	@staticmethod
+	def acquire(buf, re_list, re_tag):
+		"""acquire(buf, re_list, re_tag) -> Structure
+
+		Returns the structure of buf, shared between all views of the buffer.
+		Release it with release().
+		"""
+
+		ret = buf.get_data(Constants.STRUCTURE_KEY)
+
+		if ret == None:
+			ret = Structure(buf, re_list, re_tag)
+
+		ret._refcount += 1
+		return ret
+
+	def release(self):
+		self._refcount -= 1
+
+		if self._refcount == 0:
+			self.stop()
+
+	def stop(self):
+		self._buffer.buffer.set_data(Constants.STRUCTURE_KEY, None)
+		self.disconnect_signals(self._buffer.buffer)
+
+		for index in self._all_indexes():
+			index.clear()
+
+		self._dirty.clear()
+
+	def _all_indexes(self):
+		return self._indexes.values() + [self._stops]
+
+	def _classify(self, i, line):
+		stripped = line.strip()
+		match = self._re_list.match(line)
+
+		# Text lines are not stored
+		if match:
+			tag = self._re_tag.match(line)
+			node = Structure.Line('item', match.group(1), match.group(2), tag and tag.group(4))
+		elif stripped == '':
+			node = Structure.Line('blank', line)
+		elif stripped.startswith('%'):
+			node = Structure.Line('header', line[0:len(line) - len(line.lstrip())])
+		elif line.startswith('#'):
+			# Like the language, comments only start at the start of a line
+			node = Structure.Line('comment', '')
+		else:
+			node = None
+
+		if node != None:
+			self._indexes[node.kind].insert(node, i)
+
+		if stripped == '' or (not line.startswith(' ') and not line.startswith('\t')):
+			self._stops.insert(LineIndex.Node(), i)
+
+	def _flush(self, first, last):
+		# Classifies the dirty lines from first up to last
+		if len(self._dirty) == 0:
+			return
+
+		last = min(last, self._buffer.get_line_count())
+
+		for start, end in self._dirty.ranges(first, last):
+			for index in self._all_indexes():
+				for node in index.between(start, end - 1):
+					index.remove(node)
+
+			for i in xrange(start, end):
+				self._classify(i, self._buffer.line_at_offset(i))
+
+		self._dirty.discard(first, last)
+
+	def _find_before(self, i, find):
+		# Classifies backwards from line i in growing steps, until find
+		# returns a result among the classified lines or the start is reached
+		end = i + 1
+		step = 64
+
+		while True:
+			start = max(0, end - step)
+			self._flush(start, end)
+
+			ret = find(start)
+
+			if ret != None or start == 0:
+				return ret
+
+			end = start
+			step *= 2
+
+	def line(self, i):
+		"""line(i) -> Structure.Line of line i, or None for a text line"""
+
+		self._flush(i, i + 1)
+
+		for index in self._indexes.values():
+			nodes = index.at_line(i)
+
+			if nodes:
+				return nodes[0]
+
+		return None
+
+	def items(self, first, last):
+		"""items(first, last) -> lines with list items from first up to last"""
+
+		self._flush(first, last + 1)
+
+		return map(lambda x: x.line, self._indexes['item'].between(first, last))
+
+	def parent_item(self, i):
+		"""parent_item(i) -> line of the list item which line i continues
+
+		Looks back from the line before i for an indented list item, up to the
+		first blank or not indented line. Returns None if there is none.
+		"""
+
+		if i == 0:
+			return None
+
+		def find(start):
+			stop = self._stops.before(i - 1)
+
+			if stop == None or stop.line < start:
+				return None
+
+			return stop
+
+		# Only the lines up to the first stop before i matter
+		stop = self._find_before(i - 1, find)
+		item = self._indexes['item'].before(i - 1)
+
+		if item == None or (stop != None and stop.line >= item.line):
+			return None
+
+		return item.line
+
+	def on_insert_text(self, buf, location, text, length):
+		line = location.get_line()
+		count = text.count('\n') + text.count('\r') - text.count('\r\n') + \
+		        text.count(u'\u2029'.encode('utf-8'))
+
+		if count > 0:
+			self._dirty.insert_lines(line, count)
+
+			for index in self._all_indexes():
+				index.shift(line + 1, count)
+
+		self._dirty.add(line, line + count + 1)
+
+	def on_delete_range(self, buf, start, end):
+		first, last = sorted((start.get_line(), end.get_line()))
+
+		if last > first:
+			self._dirty.remove_lines(first, last)
+
+			for index in self._all_indexes():
+				index.join(first, last)
+
+		self._dirty.add(first, first + 1)
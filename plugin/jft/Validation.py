@@ -1,7 +1,14 @@
 import glib
-import bisect
+import gtk
+import re
+import sys
+import time
 
 from BufferUtils import BufferUtils
+from LineIndex import LineIndex
+from DirtyRanges import DirtyRanges
+from Coverage import Coverage
+from Scanner import Scanner
 from Signals import Signals
 from Validators import ValidatorMeta
 from Validators import ValidatorLatex
@@ -10,12 +17,31 @@ from Validators import ValidatorStrong
 import Constants
 
 class Validation(Signals):
-	class Bounds(object):
-		def __init__(self, start, end):
+	# Line terminators, as recognised by gtk
+	line_ends = re.compile(u'(\r\n|\r|\n|\u2029)')
+
+	class Bounds(LineIndex.Node):
+		__slots__ = ('start', 'end', 'validator', 'match', '_data')
+
+		def __init__(self, validator, start, end):
+			LineIndex.Node.__init__(self)
+
+			self.validator = validator
 			self.start = start
 			self.end = end
-			self.active = False
-			self.data = {}
+			self.match = None
+			self._data = None
+
+			self.start.set_data(Constants.VALIDATOR_KEY, validator)
+			self.end.set_data(Constants.VALIDATOR_KEY, validator)
+
+		@property
+		def data(self):
+			# Most validators never store anything
+			if self._data == None:
+				self._data = {}
+
+			return self._data
 		
 		def _get_iter(self, mark):
 			if mark.get_deleted():
@@ -39,49 +65,24 @@ class Validation(Signals):
 		
 		def get_text(self):
 			return self.start_iter().get_slice(self.end_iter())
-		
-		def __cmp__(self, other):
-			cm = cmp(self.start, other.start)
-			
-			if cm == 0:
-				return cmp(self.end, other.end)
-			else:
-				return cm
 
-	class SortedMark(object):
-		def __init__(self, line, validator, bounds):
-			self.line = line
-			self.validator = validator
-			self.bounds = bounds
-			
-			self.bounds.start.set_data(Constants.VALIDATOR_KEY, validator)
-			self.bounds.end.set_data(Constants.VALIDATOR_KEY, validator)
-			
-			self.compare_direct = False
-		
 		def valid(self):
-			return self.validator.match_exact(self.bounds.get_text())
-		
+			return self.validator.match_exact(self.get_text())
+
 		def stop(self):
-			self.validator.remove(self.bounds)
-			self.bounds.start.set_data(Constants.VALIDATOR_KEY, None)
-			self.bounds.end.set_data(Constants.VALIDATOR_KEY, None)
-			self.bounds.remove()
-		
-		def __cmp__(self, other):
-			if isinstance(other, Validation.SortedMark):
-				if self.compare_direct or other.compare_direct:
-					return cmp(super(object, self), other)
-				else:
-					return cmp(self.line, other.line)
-			else:
-				return cmp(self.line, other)
+			self.validator.remove(self)
+			self.start.set_data(Constants.VALIDATOR_KEY, None)
+			self.end.set_data(Constants.VALIDATOR_KEY, None)
+			self.remove()
 		
 	def __init__(self, view):
 		Signals.__init__(self)
 
 		buf = view.get_buffer()
+		buf.set_data(Constants.VALIDATION_KEY, self)
+
 		self._view = view
+		self._views = [view]
 		self._buffer = BufferUtils(buf)
 		
 		self.connect_signal(buf, 'delete-range', self.on_delete_range)
@@ -89,36 +90,137 @@ class Validation(Signals):
 		self.connect_signal(buf, 'cursor-moved', self.on_cursor_moved)
 		self.connect_signal(buf, 'save', self.on_save)
 		self.connect_signal(buf, 'saved', self.on_saved)
+		self.connect_signal(buf, 'loaded', self.on_loaded)
 		
 		self._buffer.connect_insert_text(self.on_insert_text)
 		
-		self._invalid_lines = []
+		self._invalid_lines = DirtyRanges()
 		self._invalid_idle_id = 0
-		self._sorted_marks = []
+		self._invalid_total = 0
+		self._cursor_idle_id = 0
+		self._ignore_deletes = False
+		self._index = LineIndex()
 		self._active_items = []
-		
+
+		self._coverage = Coverage()
+		self._coverage_id = 0
+		self._adjustments = {}
+
+		self._lazy = self._use_lazy()
+
+		self._connect_view(view)
 		self._initialize_validators()
-		self._invalidate(*buf.get_bounds())
+
+		if self._lazy:
+			self._update_coverage()
+		else:
+			self._invalidate(*buf.get_bounds())
+
+	@staticmethod
+	def acquire(view):
+		"""acquire(view) -> Validation
+
+		Returns the validation of the buffer of view, shared between all views
+		of the same buffer. Release it with release(view).
+		"""
+
+		ret = view.get_buffer().get_data(Constants.VALIDATION_KEY)
+
+		if ret == None:
+			ret = Validation(view)
+		else:
+			ret.add_view(view)
+
+		return ret
+
+	def release(self, view):
+		self.remove_view(view)
+
+		if not self._views:
+			self.stop()
+
+	def _use_lazy(self):
+		# Small documents are validated completely
+		return Constants.LAZY_VALIDATION and \
+		       isinstance(self._view.get_parent(), gtk.ScrolledWindow) and \
+		       self._buffer.get_line_count() >= Constants.LAZY_VALIDATION_LINES
+
+	def _connect_view(self, view):
+		parent = view.get_parent()
+
+		# Also for small documents, a document loaded later can be large
+		if Constants.LAZY_VALIDATION and isinstance(parent, gtk.ScrolledWindow):
+			adjustment = parent.get_vadjustment()
+			self._adjustments[view] = adjustment
+
+			self.connect_signal(adjustment, 'value-changed', self.on_adjustment_changed)
+			self.connect_signal(adjustment, 'changed', self.on_adjustment_changed)
+
+	def add_view(self, view):
+		if view in self._views:
+			return
+
+		self._views.append(view)
+		self._connect_view(view)
+
+		for validator in self._validators:
+			validator.add_view(view)
+
+		if self._lazy:
+			self.on_adjustment_changed(None)
+
+	def remove_view(self, view):
+		if not view in self._views:
+			return
+
+		self._views.remove(view)
+
+		if view in self._adjustments:
+			self.disconnect_signals(self._adjustments[view])
+			del self._adjustments[view]
+
+		if self._views:
+			self._view = self._views[0]
+
+			for validator in self._validators:
+				validator.remove_view(view)
 	
 	def _invalidate_all(self):
-		active = list(self._sorted_marks)
+		active = list(self._index)
+		self._index.clear()
 
 		for a in active:
 			if a in self._active_items:
 				self._active_items.remove(a)
-				
-			self._sorted_marks.remove(a)
+
 			a.stop()
 	
 	def stop(self):
 		if self._invalid_idle_id != 0:
 			glib.source_remove(self._invalid_idle_id)
 			self._invalid_idle_id = 0
+
+		if self._coverage_id != 0:
+			glib.source_remove(self._coverage_id)
+			self._coverage_id = 0
+
+		if self._cursor_idle_id != 0:
+			glib.source_remove(self._cursor_idle_id)
+			self._cursor_idle_id = 0
+
+		for adjustment in self._adjustments.values():
+			self.disconnect_signals(adjustment)
+
+		self._adjustments = {}
 		
 		self.disconnect_signals(self._buffer.buffer)
+		self._buffer.set_data(Constants.VALIDATION_KEY, None)
 		self._buffer.disconnect_insert_text(self.on_insert_text)
 
 		self._invalidate_all()
+
+		for validator in self._validators:
+			validator.stop()
 	
 	def _initialize_validators(self):
 		self._validators = [
@@ -127,6 +229,8 @@ class Validation(Signals):
 			ValidatorEmphasize(self._view),
 			ValidatorStrong(self._view)
 		]
+
+		self._scanner = Scanner(self._validators)
 	
 	def iter_with_offset(self, start, offset):
 		piter = start.copy()
@@ -138,30 +242,28 @@ class Validation(Signals):
 		return [self.iter_with_offset(start, match.start(0)),
 				self.iter_with_offset(start, match.end(0))]
 	
-	def _has_validator_at_iter(self, validator, piter):
-		marks = piter.get_marks()
-		
-		for mark in marks:
-			val = mark.get_data(Constants.VALIDATOR_KEY)
-			
-			if val == validator:
-				return True
-		
-		return False
-	
-	def _add_validate(self, validator, start, match):
-		iters = self._iters_for_match(match, start)
-		
-		# See if it actually is already active here
-		if self._has_validator_at_iter(validator, iters[0]) and \
-		   self._has_validator_at_iter(validator, iters[1]):
-			return
+	def _offsets(self, items):
+		# Maps (validator, start offset, end offset) to the bounds, to see
+		# if a match is already active
+		ret = {}
+
+		for bounds in items:
+			start, end = bounds.start_iter(), bounds.end_iter()
+
+			if start != None and end != None:
+				ret[(bounds.validator, start.get_offset(), end.get_offset())] = bounds
+
+		return ret
+
+	def _create_bounds(self, validator, start, end):
+		bounds = Validation.Bounds(validator, *self._buffer.create_mark_range(start, end))
+		self._index.insert(bounds, start.get_line(), end.get_line() - start.get_line())
+
+		return bounds
+
+	def _validate_bounds(self, bounds, match):
+		validator = bounds.validator
 
-		bounds = Validation.Bounds(*self._buffer.create_mark_range(iters[0], iters[1]))
-		
-		item = Validation.SortedMark(iters[0].get_line(), validator, bounds)
-		bisect.insort(self._sorted_marks, item)
-		
 		validator.add(bounds)
 		validator.validate(bounds, match)
 		
@@ -169,136 +271,366 @@ class Validation(Signals):
 		start, end = bounds.start_iter(), bounds.end_iter()
 		
 		if piter.in_range(start, end):
-			self._active_items.append(item)
+			self._active_items.append(bounds)
 			validator.enter(bounds)
 
-	def _is_active(self, mark, line):
-		return mark.bounds.start_iter().get_line() == line
+	def _is_active(self, bounds, line):
+		start = bounds.start_iter()
+
+		return start != None and start.get_line() == line
 
 	def _find_possible_active(self, line):
-		if not self._sorted_marks:
-			return []
-			
-		idx = bisect.bisect_left(self._sorted_marks, line)
-		length = len(self._sorted_marks)
+		return filter(lambda x: self._is_active(x, line), self._index.at_line(line))
+
+	def progress(self):
+		"""progress() -> (lines done, lines invalidated)
+
+		Progress of the current revalidation, both are 0 when everything is
+		up to date.
+		"""
+
+		return (self._invalid_total - len(self._invalid_lines), self._invalid_total)
+
+	def _stop_invalid(self, items):
+		# Try to invalidate any active stuff, see if it still matches. Returns
+		# the items which are still valid
 		ret = []
-		
-		while idx < length and self._is_active(self._sorted_marks[idx], line):
-			ret.append(self._sorted_marks[idx])
-			idx += 1
-		
+
+		for a in items:
+			if not a.valid():
+				if a in self._active_items:
+					self._active_items.remove(a)
+
+				self._index.remove(a)
+				a.stop()
+			else:
+				ret.append(a)
+
+		return ret
+
+	def _revalidate_line(self, i):
+		existing = self._offsets(self._stop_invalid(self._find_possible_active(i)))
+
+		# And then try to validate some stuff, match offsets are in characters
+		start = self._buffer.get_iter_at_line(i)
+		offset = start.get_offset()
+		line = self._buffer.line_at_iter(start).decode('utf-8')
+
+		created = []
+
+		# Create all the marks first, validating can insert images which
+		# moves the text after them
+		for validator, match in self._scanner.scan(line):
+			if (validator, offset + match.start(0), offset + match.end(0)) in existing:
+				continue
+
+			start = self._buffer.get_iter_at_line(i)
+			created.append((self._create_bounds(validator, *self._iters_for_match(match, start)), match))
+
+		for bounds, match in created:
+			self._validate_bounds(bounds, match)
+
+	def check_index(self):
+		"""check_index() -> list of errors
+
+		Compares the validation index with the marks in the buffer, for
+		debugging.
+		"""
+
+		ret = []
+		seen = {}
+		marks = {}
+
+		for bounds in self._index:
+			marks[bounds.start] = bounds
+			marks[bounds.end] = bounds
+
+		for bounds in self._index:
+			start, end = bounds.start_iter(), bounds.end_iter()
+
+			if start == None or end == None:
+				ret.append('bounds with deleted marks')
+				continue
+
+			if bounds.start.get_data(Constants.VALIDATOR_KEY) != bounds.validator or \
+			   bounds.end.get_data(Constants.VALIDATOR_KEY) != bounds.validator:
+				ret.append('marks at offset %d do not belong to their validator' % (start.get_offset(),))
+
+			if self._index.line(bounds) != start.get_line():
+				ret.append('bounds at line %d indexed at line %d' % (start.get_line(), self._index.line(bounds)))
+
+			key = (bounds.validator, start.get_offset(), end.get_offset())
+
+			if key in seen:
+				ret.append('duplicate bounds at offset %d' % (start.get_offset(),))
+
+			seen[key] = bounds
+
+			# Validator marks which are not in the index
+			for piter in (start, end):
+				for mark in piter.get_marks():
+					if mark.get_data(Constants.VALIDATOR_KEY) != None and not mark in marks:
+						ret.append('stray mark at offset %d' % (piter.get_offset(),))
+
 		return ret
 
+	def _bulk_validate(self):
+		# Fetch the text of all invalid lines at once, split it into lines
+		# without going through iters and convert the match offsets to iters
+		# in a single sweep
+		found = []
+		existing = {}
+
+		for first, end in self._invalid_lines.ranges():
+			start = self._buffer.get_iter_at_line(first)
+			stop = start.copy()
+			stop.forward_lines(end - first)
+
+			existing.update(self._offsets(self._stop_invalid(self._index.between(first, end - 1))))
+
+			offset = start.get_offset()
+			parts = Validation.line_ends.split(start.get_slice(stop).decode('utf-8'))
+
+			for i in range(0, min(len(parts), 2 * (end - first)), 2):
+				for validator, match in self._scanner.scan(parts[i]):
+					found.append((offset + match.start(0), offset + match.end(0), validator, match))
+
+				offset += len(parts[i])
+
+				if i + 1 < len(parts):
+					offset += len(parts[i + 1])
+
+		found.sort(key=lambda x: x[0:2])
+
+		# Create all the marks first, validating can insert images which
+		# invalidates iters
+		piter = self._buffer.get_start_iter()
+		pos = 0
+		created = []
+
+		for start, end, validator, match in found:
+			if (validator, start, end) in existing:
+				continue
+
+			piter.forward_chars(start - pos)
+			pos = start
+
+			other = piter.copy()
+			other.forward_chars(end - start)
+
+			created.append((self._create_bounds(validator, piter, other), match))
+
+		for bounds, match in created:
+			self._validate_bounds(bounds, match)
+
+		self._invalid_lines.clear()
+		self._invalid_total = 0
+
+	def on_loaded(self, doc, error):
+		if error:
+			return
+
+		# Start over for the loaded text, and validate it in bulk. The
+		# incremental path takes over for edits
+		self._invalid_lines.clear()
+		self._invalid_total = 0
+
+		self._lazy = self._use_lazy()
+		self._coverage.clear()
+
+		if self._lazy:
+			self._update_coverage()
+		else:
+			self._invalidate(*doc.get_bounds())
+
+		self._bulk_validate()
+
+	def _visible_lines(self, view):
+		rect = view.get_visible_rect()
+
+		first = view.get_line_at_y(rect.y)[0].get_line()
+		last = view.get_line_at_y(rect.y + rect.height)[0].get_line()
+
+		return first, last
+
+	def _next_invalid(self, cursor, first, last):
+		# The cursor line first, then the lines in view and then spreading
+		# out from the view
+		if self._invalid_lines.contains(cursor):
+			return cursor
+
+		return self._invalid_lines.nearest(first, last)
+
 	def _revalidate_idle(self):
+		# Revalidate in slices so that large documents do not block the
+		# main loop
+		started = time.time()
+		budget = Constants.VALIDATION_BUDGET / 1000.0
+
+		cursor = self._buffer.insert_iter().get_line()
+		first, last = self._visible_lines(self._view)
+
+		while self._invalid_lines and time.time() - started < budget:
+			i = self._next_invalid(cursor, first, last)
+
+			self._invalid_lines.discard(i, i + 1)
+			self._revalidate_line(i)
+
+		if self._invalid_lines:
+			return True
+
 		self._invalid_idle_id = 0
-		
-		# Try to invalidate any active stuff
-		for i in self._invalid_lines:
-			active = self._find_possible_active(i)
-			
-			# See if still matches
-			for a in active:
-				if not a.valid():
-					a.compare_direct = True
+		self._invalid_total = 0
 
-					if a in self._active_items:
-						self._active_items.remove(a)
+		if Constants.DEBUG_VALIDATION:
+			for error in self.check_index():
+				print >> sys.stderr, 'Validation: %s' % (error,)
 
-					self._sorted_marks.remove(a)
-					a.stop()
-		
-		# And then try to validate some stuff
-		for validator in self._validators:
-			for i in self._invalid_lines:
-				start = self._buffer.get_iter_at_line(i)
-				line = self._buffer.line_at_iter(start)
-			
-				for match in validator.match(line):
-					self._add_validate(validator, start, match)
-		
-		self._invalid_lines = []
 		return False
 	
+	def _invalidate_lines(self, first, last):
+		size = len(self._invalid_lines)
+		self._invalid_lines.add(first, last + 1)
+
+		self._invalid_total += len(self._invalid_lines) - size
+
+		if self._invalid_idle_id == 0:
+			self._invalid_idle_id = glib.idle_add(self._revalidate_idle)
+
 	def _invalidate(self, start, end):
 		r = [start.get_line(), end.get_line()]
 		r.sort()
-		
-		self._invalid_lines = list(set(self._invalid_lines + range(r[0], r[1] + 1)))
 
-		if self._invalid_idle_id == 0:
-			self._invalid_idle_id = glib.idle_add(self._revalidate_idle)
+		if not self._lazy:
+			self._invalidate_lines(*r)
+			return
+
+		# Lines out of view are validated when they come into view
+		for first, last in self._coverage.clip(*r):
+			self._invalidate_lines(first, last)
+
+	def _drop_lines(self, first, last):
+		self._invalid_lines.discard(first, last + 1)
+
+		for bounds in self._index.between(first, last):
+			if bounds in self._active_items:
+				self._active_items.remove(bounds)
+
+			self._index.remove(bounds)
+			bounds.stop()
+
+	def _update_coverage(self):
+		self._coverage_id = 0
+		now = time.time()
+
+		for view in self._views:
+			first, last = self._visible_lines(view)
+			margin = max(last - first, Constants.VALIDATION_MARGIN)
+
+			first = max(0, first - margin)
+			last = min(self._buffer.get_line_count() - 1, last + margin)
+
+			for r in self._coverage.extend(first, last, now):
+				self._invalidate_lines(*r)
+
+		for r in self._coverage.expire(now - Constants.VALIDATION_EXPIRE):
+			self._drop_lines(*r)
+
+		return False
+
+	def on_adjustment_changed(self, adjustment):
+		if self._lazy and self._coverage_id == 0:
+			self._coverage_id = glib.idle_add(self._update_coverage)
 
 	def on_insert_text(self, start, location):
+		line = start.get_line()
+		diff = location.get_line() - line
+
+		if diff > 0:
+			self._coverage.insert_lines(line, diff)
+			self._invalid_lines.insert_lines(line, diff)
+
 		self._invalidate(start, location)
 		self._insert_text_start = None
 		
-		diff = location.get_line() - start.get_line()
-		
 		if diff > 0:
-			idx = bisect.bisect_right(self._sorted_marks, start.get_line() + 1)
-			
-			for i in range(idx, len(self._sorted_marks)):
-				self._sorted_marks[i].line += diff
+			self._index.shift(line + 1, diff)
+
+			# Items after the insertion point moved to a new line
+			for bounds in self._index.at_line(line):
+				piter = bounds.start_iter()
+
+				if piter != None and piter.get_line() != line:
+					end = bounds.end_iter().get_line()
+
+					self._index.remove(bounds)
+					self._index.insert(bounds, piter.get_line(), end - piter.get_line())
 	
 	def on_delete_range(self, buf, start, end):
+		if self._ignore_deletes:
+			return
+
 		self._delete_range = [start.get_line(), end.get_line()]
 		self._delete_range.sort()
 	
 	def on_delete_range_after(self, buf, start, end):
+		if self._ignore_deletes:
+			return
+
 		diff = self._delete_range[1] - self._delete_range[0]
 		
 		if diff > 0:
-			self._invalid_lines = filter(lambda x: x <= self._delete_range[0] or x >= self._delete_range[1], self._invalid_lines)
-
-			idx = bisect.bisect_left(self._invalid_lines, self._delete_range[1])
-			
-			for i in range(idx, len(self._invalid_lines)):
-				self._invalid_lines[i] -= diff
-			
-			idx = bisect.bisect_left(self._sorted_marks, self._delete_range[1])
-			
-			for i in range(idx, len(self._sorted_marks)):
-				self._sorted_marks[i].line -= diff
+			self._invalid_lines.remove_lines(*self._delete_range)
+			self._index.join(*self._delete_range)
+			self._coverage.remove_lines(*self._delete_range)
 		
 		self._invalidate(start, end)
 	
 	def cursor_moved_real(self):
+		self._cursor_idle_id = 0
+
 		# Update active bounds status
 		piter = self._buffer.insert_iter()
-		items = self._find_possible_active(piter.get_line())
+		items = self._index.containing(piter.get_line())
 		
 		for item in list(self._active_items):
-			start, end = item.bounds.start_iter(), item.bounds.end_iter()
+			start, end = item.start_iter(), item.end_iter()
 
 			if not piter.in_range(start, end):
-				item.compare_direct = True
 				self._active_items.remove(item)
-				item.compare_direct = False
-
-				item.validator.exit(item.bounds)
+				item.validator.exit(item)
 				piter = self._buffer.insert_iter()
 
 		for item in items:
-			start, end = item.bounds.start_iter(), item.bounds.end_iter()
+			start, end = item.start_iter(), item.end_iter()
 			
 			if piter.in_range(start, end) and \
 			   not (item in self._active_items):	
 				self._active_items.append(item)
-				item.validator.enter(item.bounds)
+				item.validator.enter(item)
 				piter = self._buffer.insert_iter()
 
 		return False
 	
 	def on_cursor_moved(self, doc):
-		glib.idle_add(self.cursor_moved_real)
+		if self._cursor_idle_id == 0:
+			self._cursor_idle_id = glib.idle_add(self.cursor_moved_real)
 	
 	def _store_for_save(self):
-		for item in self._sorted_marks:
-			item.validator.store_for_save(item.bounds)
+		# The formula anchors are still taken out of the buffer for the save
+		# and put back after it, with new images in every view. Removing them
+		# does not change the text, so there is nothing to revalidate
+		self._ignore_deletes = True
+
+		try:
+			for item in self._index:
+				item.validator.store_for_save(item)
+		finally:
+			self._ignore_deletes = False
 	
 	def _restore_after_save(self):
-		for item in self._sorted_marks:
-			item.validator.restore_after_save(item.bounds)
+		for item in self._index:
+			item.validator.restore_after_save(item)
 	
 	def on_save(self, *args):
 		self._store_for_save()
@@ -1,18 +1,24 @@
 from BufferUtils import BufferUtils
+from LatexCache import LatexCache
+from LatexRender import LatexTemplate, RenderQueue, RenderRequest, RasterJob
+from MathRender import MathRender
+import Constants
 import re
 import os
-import subprocess
+import sys
+import time
 import pango
 from gtk import gdk
-import tempfile
-import signal
 import glib
 import gtk
-import glob
 
 class Validator:
+	# Characters matches can start with, None when unknown
+	first_chars = None
+
 	def __init__(self, view, rule = None):
 		self._view = view
+		self._views = [view]
 		self._buffer = BufferUtils(view.get_buffer())
 
 		if rule:
@@ -23,12 +29,24 @@ class Validator:
 		self.active = []
 
 	def stop(self):
-		for a in self._active:
+		for a in self.active:
 			a.remove()
 
 		self._buffer = None
 		self.active = []
 
+	def add_view(self, view):
+		# Validators are shared between all views of a buffer
+		if not view in self._views:
+			self._views.append(view)
+
+	def remove_view(self, view):
+		if view in self._views:
+			self._views.remove(view)
+
+			if self._views:
+				self._view = self._views[0]
+
 	def add(self, bounds):
 		if not bounds in self.active:
 			self.active.append(bounds)
@@ -50,6 +68,10 @@ class Validator:
 
 		return res
 
+	def matcher(self):
+		# Matches the rule at a position of a line, for the scanner
+		return self._rule.match
+
 	def remove(self, bounds):
 		self.invalidate(bounds)
 		self.active.remove(bounds)
@@ -113,6 +135,9 @@ class ValidatorHide(Validator):
 		Validator.stop(self)
 
 	def validate(self, bounds, match):
+		# Keep the match around for exit
+		bounds.match = match
+
 		self._buffer.apply_tag(self._tag_invisible, *self.iters_for(bounds, match, 0))
 
 		for idx in self._visible_parts:
@@ -129,8 +154,13 @@ class ValidatorHide(Validator):
 		self.invalidate(bounds)
 
 	def exit(self, bounds):
-		# And make it invisible again
-		match = self._rule.match(bounds.get_text())
+		# And make it invisible again, the text is unchanged unless the
+		# bounds were edited
+		text = bounds.get_text().decode('utf-8')
+		match = bounds.match
+
+		if match == None or match.group(0) != text:
+			match = self._rule.match(text)
 
 		if not match:
 			return
@@ -138,6 +168,8 @@ class ValidatorHide(Validator):
 		self.validate(bounds, match)
 
 class ValidatorMeta(ValidatorHide):
+	first_chars = '{'
+
 	def __init__(self, view):
 		ValidatorHide.__init__(self,
 							   view,
@@ -145,24 +177,148 @@ class ValidatorMeta(ValidatorHide):
 							   (2,))
 
 class ValidatorEmphasize(ValidatorHide):
+	first_chars = '\''
+
 	def __init__(self, view):
 		ValidatorHide.__init__(self, view, '\'{3}([^\']+)\'{3}', (1,))
 
 class ValidatorStrong(ValidatorHide):
+	first_chars = '_'
+
 	def __init__(self, view):
 		ValidatorHide.__init__(self, view, '_{2}([^_]+)_{2}', (1,))
 
 class ValidatorLatex(ValidatorHide):
+	first_chars = '$'
+	cache = None
+	template = None
+	math = MathRender()
+
+	# How formulas were rendered, for debugging
+	tiers = {'fast': 0, 'cached': 0, 'latex': 0, 'failed': 0, 'avoided': 0}
+
 	def __init__(self, view):
 		ValidatorHide.__init__(self,
 		                       view,
 		                       '\\$(.*?)\\$',
 		                       [])
 
-		self.template = file(os.path.join(os.path.dirname(__file__), 'template.tex')).read()
+		# Formulas further offscreen than this many view heights are not
+		# rendered until they come closer
+		self.offscreen_margin = 3
+
+		self._requests = {}
+		self._deferred = []
+		self._scroll_idle_id = 0
+
+		self._settings = None
+		self._rerender_id = 0
+		self._raster_job = None
+
+		# Formulas waiting for a quiet period after editing, before they are
+		# rendered
+		self._waiting = []
+		self._waiting_id = 0
+		self._last_edit = 0
+
+		# Formulas which failed to compile
+		self._tag_error = self._buffer.create_tag(None, underline=pango.UNDERLINE_ERROR)
+
+		# The cache, template and render queue are shared between all views
+		if ValidatorLatex.cache == None:
+			ValidatorLatex.cache = LatexCache()
+
+		if ValidatorLatex.template == None:
+			ValidatorLatex.template = LatexTemplate(os.path.join(os.path.dirname(__file__), 'template.tex'))
+
+		ValidatorLatex.template.prepare_format(ValidatorLatex.cache)
+
+		self._queue = RenderQueue.default()
+
+		# Signal handlers of the buffer (None) and of each view
+		self._handlers = {}
+
+		self._connect(None, self._buffer.buffer, 'notify::style-scheme', self.on_style_changed)
+		self._connect(None, self._buffer.buffer, 'end-user-action', self.on_user_action)
+
+		self._connect_view(view)
+
+	def _connect(self, view, obj, name, handler):
+		self._handlers.setdefault(view, []).append((obj, obj.connect(name, handler)))
 
-		self._running_procs = {}
-		self._timeout_id = 0
+	def _disconnect(self, view):
+		for obj, hid in self._handlers.pop(view, []):
+			obj.disconnect(hid)
+
+	def _connect_view(self, view):
+		parent = view.get_parent()
+
+		if isinstance(parent, gtk.ScrolledWindow):
+			adjustment = parent.get_vadjustment()
+
+			self._connect(view, adjustment, 'value-changed', self.on_adjustment_changed)
+			self._connect(view, adjustment, 'changed', self.on_adjustment_changed)
+
+		# Font and style scheme changes
+		self._connect(view, view, 'style-set', self.on_style_changed)
+
+		view.set_property('has-tooltip', True)
+		self._connect(view, view, 'query-tooltip', self.on_query_tooltip)
+
+	def add_view(self, view):
+		if view in self._views:
+			return
+
+		ValidatorHide.add_view(self, view)
+		self._connect_view(view)
+
+		# The images are widgets of a single view
+		for bounds in self.active:
+			if 'anchor' in bounds.data:
+				self._add_image(view, bounds)
+
+	def remove_view(self, view):
+		self._disconnect(view)
+		ValidatorHide.remove_view(self, view)
+
+	def stop(self):
+		for view in self._handlers.keys():
+			self._disconnect(view)
+
+		if self._scroll_idle_id != 0:
+			glib.source_remove(self._scroll_idle_id)
+			self._scroll_idle_id = 0
+
+		if self._rerender_id != 0:
+			glib.source_remove(self._rerender_id)
+			self._rerender_id = 0
+
+		if self._waiting_id != 0:
+			glib.source_remove(self._waiting_id)
+			self._waiting_id = 0
+
+		if self._raster_job:
+			self._raster_job.kill()
+			self._raster_job.cleanup()
+			self._raster_job = None
+
+		# Kill any outstanding renders
+		for bounds in self._requests.keys():
+			self._stop_running(bounds)
+
+		self._buffer.get_tag_table().remove_tag(self._tag_error)
+
+		ValidatorHide.stop(self)
+
+	@staticmethod
+	def debug_stats():
+		ret = dict(ValidatorLatex.tiers)
+
+		if ValidatorLatex.cache:
+			ret['cache'] = ValidatorLatex.cache.stats()
+
+		ret['queue'] = RenderQueue.default().stats()
+		return ret
 
 	def get_foreground_color(self):
 		style = self._buffer.get_style_scheme().get_style('jft:latex-math')
@@ -175,20 +331,80 @@ class ValidatorLatex(ValidatorHide):
 		else:
 			return '#000'
 
+	def priority(self, bounds):
+		# Distance in pixels from the visible part of the closest view
+		start = bounds.start_iter()
+
+		if not start:
+			return sys.maxint
+
+		ret = sys.maxint
+
+		for view in self._views:
+			rect = view.get_visible_rect()
+			y, height = view.get_line_yrange(start)
+
+			if y + height < rect.y:
+				ret = min(ret, rect.y - (y + height))
+			elif y > rect.y + rect.height:
+				ret = min(ret, y - (rect.y + rect.height))
+			else:
+				return 0
+
+		return ret
+
+	def _offscreen_distance(self):
+		height = max(map(lambda x: x.get_visible_rect().height, self._views))
+
+		# Not allocated yet, so nothing is offscreen
+		if height <= 1:
+			return None
+
+		return height * self.offscreen_margin
+
+	def _update_offscreen(self):
+		self._scroll_idle_id = 0
+		self._queue.reprioritise(self)
+
+		distance = self._offscreen_distance()
+
+		if distance == None:
+			return False
+
+		# Cancel queued formulas which scrolled far away, and submit the
+		# ones that came close again
+		deferred = self._queue.cancel_offscreen(self, distance)
+
+		for request in list(self._deferred):
+			if self.priority(request.bounds) <= distance:
+				self._deferred.remove(request)
+				self._queue.submit(request)
+
+		self._deferred.extend(deferred)
+		return False
+
+	def on_adjustment_changed(self, adjustment):
+		if self._scroll_idle_id == 0:
+			self._scroll_idle_id = glib.idle_add(self._update_offscreen)
+
 	def _stop_running(self, bounds):
-		if bounds in self._running_procs:
-			info = self._running_procs[bounds]
+		if bounds in self._requests:
+			request = self._requests[bounds]
+			del self._requests[bounds]
 
-			os.kill(info[1].pid, signal.SIGTERM)
-			self._cleanup_files(info[0])
+			if request in self._deferred:
+				self._deferred.remove(request)
 
-			del self._running_procs[bounds]
+			if request in self._waiting:
+				# Edited again before latex even started
+				self._waiting.remove(request)
+				ValidatorLatex.tiers['avoided'] += 1
 
-			if len(self._running_procs) == 0:
-				glib.source_remove(self._timeout_id)
-				self._timeout_id = 0
+			request.token.cancel()
 
-	def _remove_pixbuf(self, bounds):
+	def _detach_anchor(self, bounds):
+		# Removes the anchor from the buffer, gtk destroys the images
+		# attached to it
 		if 'anchor' in bounds.data:
 			if not bounds.data['anchor'].get_deleted():
 				mod = self._buffer.get_modified()
@@ -204,19 +420,12 @@ class ValidatorLatex(ValidatorHide):
 
 			del bounds.data['anchor']
 
-	def _show_pixbuf(self, bounds, image = None):
-		# Make text invisible
-		self._buffer.apply_tag(self._tag_invisible, bounds.start_iter(), bounds.end_iter())
-
-		self._remove_pixbuf(bounds)
-
+	def _attach_anchor(self, bounds):
 		mod = self._buffer.get_modified()
-		anchor = self._buffer.create_child_anchor(bounds.start_iter())
-		image = gtk.image_new_from_pixbuf(bounds.data['pixbuf'])
-		image.show()
+		bounds.data['anchor'] = self._buffer.create_child_anchor(bounds.start_iter())
 
-		self._view.add_child_at_anchor(image, anchor)
-		bounds.data['anchor'] = anchor
+		for view in self._views:
+			self._add_image(view, bounds)
 
 		# Also, this will put this thing in the marks, which we don't want, so
 		# move the mark
@@ -228,77 +437,379 @@ class ValidatorLatex(ValidatorHide):
 		if not mod:
 			self._buffer.set_modified(False)
 
-	def _cleanup_files(self, name):
-		for nm in glob.glob(name + '.*'):
-			os.unlink(nm)
+	def _remove_pixbuf(self, bounds):
+		self._detach_anchor(bounds)
 
-	def _process_done(self, bounds, name, ret):
-		if ret == 0:
-			# there is an image, maybe insert it
-			bounds.data['pixbuf'] = gdk.pixbuf_new_from_file(name + '.png')
+	def _add_image(self, view, bounds):
+		image = gtk.image_new_from_pixbuf(bounds.data['pixbuf'])
+		image.show()
 
-			# hide the text, all of it
-			self._show_pixbuf(bounds)
+		view.add_child_at_anchor(image, bounds.data['anchor'])
 
-		self._cleanup_files(name)
+	def _show_pixbuf(self, bounds, image = None):
+		# Make text invisible
+		self._buffer.apply_tag(self._tag_invisible, bounds.start_iter(), bounds.end_iter())
 
-	def _check_running_procs(self):
-		for bounds in self._running_procs.keys():
-			info = self._running_procs[bounds]
+		self._remove_pixbuf(bounds)
+		self._attach_anchor(bounds)
 
-			ret = info[1].poll()
+	def _show_cached(self, bounds, filename):
+		try:
+			bounds.data['pixbuf'] = gdk.pixbuf_new_from_file(filename)
+		except glib.GError:
+			return False
 
-			if ret != None:
-				self._process_done(bounds, info[0], ret)
+		# hide the text, all of it
+		self._show_pixbuf(bounds)
+		return True
 
-				del self._running_procs[bounds]
+	def _show_data(self, bounds, data):
+		loader = gdk.PixbufLoader('png')
 
-		if len(self._running_procs) == 0:
-			self._timeout_id = 0
+		try:
+			loader.write(data)
+			loader.close()
+		except glib.GError:
 			return False
+
+		bounds.data['pixbuf'] = loader.get_pixbuf()
+
+		# hide the text, all of it
+		self._show_pixbuf(bounds)
+		return True
+
+	def _dvi_key(self, job):
+		if job.dvi_key == None:
+			parts = ['dvi', self.template.template] + job.expressions
+
+			if self.template.colored_dvi():
+				parts.append(self._settings[1])
+
+			job.dvi_key = ValidatorLatex.cache.key(*parts)
+
+			data = job.dvi()
+
+			if data:
+				ValidatorLatex.cache.store_data(job.dvi_key, data, '.dvi')
+
+		return job.dvi_key
+
+	def _dvi_ref_key(self, text):
+		# The dvi and page of a single formula, also for formulas shown from
+		# the image cache
+		parts = ['dviref', self.template.template, text]
+
+		if self.template.colored_dvi():
+			parts.append(self._settings[1])
+
+		return ValidatorLatex.cache.key(*parts)
+
+	def _lookup_dvi(self, bounds, text):
+		if not 'dvi' in bounds.data:
+			filename = ValidatorLatex.cache.lookup(self._dvi_ref_key(text), '.ref')
+
+			if filename == None:
+				return None
+
+			try:
+				key, page = file(filename).read().split()
+				bounds.data['dvi'] = (key, int(page))
+			except (IOError, ValueError):
+				return None
+
+		return ValidatorLatex.cache.lookup(bounds.data['dvi'][0], '.dvi')
+
+	def _error_key(self, text):
+		return ValidatorLatex.cache.key('error', self.template.template, text)
+
+	def _tex_error(self, log):
+		# The first error line from the latex log, without the leading !
+		for line in log.splitlines():
+			if line.startswith('!'):
+				return line[1:].strip()
+
+		return None
+
+	def _show_error(self, bounds, log):
+		message = self._tex_error(log)
+
+		if message == None:
+			message = 'Failed to compile formula'
+
+		bounds.data['error'] = message
+		self._buffer.apply_tag(self._tag_error, bounds.start_iter(), bounds.end_iter())
+
+	def _clear_error(self, bounds):
+		if 'error' in bounds.data:
+			del bounds.data['error']
+
+			start = bounds.start_iter()
+
+			if start:
+				self._buffer.remove_tag(self._tag_error, start, bounds.end_iter())
+
+	def on_query_tooltip(self, view, x, y, keyboard_mode, tooltip):
+		if keyboard_mode:
+			piter = self._buffer.get_iter_at_mark(self._buffer.get_insert())
 		else:
-			return True
+			x, y = view.window_to_buffer_coords(gtk.TEXT_WINDOW_TEXT, x, y)
+			piter = view.get_iter_at_location(x, y)
 
-	def generate_latex(self, bounds):
-		self._stop_running(bounds)
+		for bounds in self.active:
+			if not 'error' in bounds.data:
+				continue
 
-		text = self._rule.match(bounds.get_text()).group(1)
+			start = bounds.start_iter()
+
+			if start and start.compare(piter) <= 0 and piter.compare(bounds.end_iter()) < 0:
+				tooltip.set_text(bounds.data['error'])
+				return True
+
+		return False
+
+	def render_done(self, request, data, job):
+		if self._requests.get(request.bounds) != request:
+			return
+
+		del self._requests[request.bounds]
+
+		if not data:
+			log = job.log()
+
+			if log:
+				# Remember errors in the formula, it is only tried again when
+				# it changes. Other failures, like dvipng not running, are
+				# tried again the next time the formula is validated
+				if self._tex_error(log) != None:
+					ValidatorLatex.cache.store_data(self._error_key(request.text), log, '.log')
+
+				self._show_error(request.bounds, log)
 
-		# Insert colors and font size
+			return
+
+		# there is an image, store it in the cache and maybe insert it
+		ValidatorLatex.cache.store_data(request.key, data)
+
+		# Keep the dvi around to rasterise it again when the font or colors
+		# change
+		dvi = (self._dvi_key(job), request.page)
+		request.bounds.data['dvi'] = dvi
+
+		ValidatorLatex.cache.store_data(self._dvi_ref_key(request.text), '%s %d' % dvi, '.ref')
+
+		self._show_data(request.bounds, data)
+
+	def _render_settings(self):
 		style = self._view.get_style()
 		fontsize = (style.font_desc.get_size() / pango.SCALE) * 1.8
 
 		dpi = fontsize * 72.27 / 10
 
 		color = gdk.color_parse(self.get_foreground_color())
+		rgb = (color.red / 65535.0, color.green / 65535.0, color.blue / 65535.0)
 
-		template = self.template.replace('#color', '%f,%f,%f' % (color.red / 65535.0,
-		                                                         color.green / 65535.0,
-		                                                         color.blue / 65535.0))
+		font = style.font_desc.copy()
+		font.set_family('Serif')
+		font.set_absolute_size(fontsize * pango.SCALE)
+
+		return dpi, '%f,%f,%f' % rgb, rgb, font
+
+	def _render_direct(self, bounds, text):
+		# Render from the cache, or simple formulas directly without running
+		# latex
+		dpi, color, rgb, font = self._settings
+
+		pixbuf = ValidatorLatex.math.render(text, rgb, font)
+
+		if pixbuf:
+			ValidatorLatex.tiers['fast'] += 1
+
+			bounds.data['pixbuf'] = pixbuf
+			self._show_pixbuf(bounds)
+			return None
 
-		template = template.replace('#expression', text)
+		key = ValidatorLatex.cache.key(self.template.template, text, color, '%f' % dpi)
+		filename = ValidatorLatex.cache.lookup(key)
 
-		# Write out temporary tex file
-		tmp = tempfile.NamedTemporaryFile()
-		name = tmp.name
-		tmp.close()
+		if filename:
+			if self._show_cached(bounds, filename):
+				ValidatorLatex.tiers['cached'] += 1
+				return None
 
-		file(name + '.tex', 'w').write(template)
+			ValidatorLatex.cache.discard(key)
 
-		# Run latex, dvipng etc
-		d = os.path.dirname(name)
-		b = os.path.basename(name)
+		filename = ValidatorLatex.cache.lookup(self._error_key(text), '.log')
 
-		cmd = 'cd "%s" && latex -halt-on-error -interaction=batchmode "%s.tex" && dvipng -o "%s.png" -T tight -D %f -bg Transparent "%s.dvi"' % (d, b, b, dpi, b)
+		if filename:
+			try:
+				self._show_error(bounds, file(filename).read())
+				ValidatorLatex.tiers['failed'] += 1
+				return None
+			except IOError:
+				pass
 
-		null = file('/dev/null')
+		return key
+
+	def _rasterised(self, job, ret, items):
+		if job != self._raster_job:
+			return
+
+		self._raster_job = None
+
+		for idx, page, bounds, key in items:
+			if not bounds in self.active or bounds in self._requests or \
+			   not 'anchor' in bounds.data:
+				continue
+
+			data = job.page(idx, page)
+
+			if data:
+				ValidatorLatex.cache.store_data(key, data)
+				self._show_data(bounds, data)
+			else:
+				self.generate_latex(bounds)
+
+		job.cleanup()
+
+	def _rerender(self):
+		self._rerender_id = 0
+
+		settings = self._render_settings()
+
+		if self._settings and self._settings[0:2] == settings[0:2]:
+			return False
 
-		proc = subprocess.Popen(cmd, shell=True, stdout=null, stderr=null)
+		self._settings = settings
 
-		if self._timeout_id == 0:
-			self._timeout_id = glib.timeout_add(200, self._check_running_procs)
+		if self._raster_job:
+			self._raster_job.kill()
+			self._raster_job.cleanup()
+			self._raster_job = None
 
-		self._running_procs[bounds] = [name, proc]
+		dvis = {}
+
+		for bounds in list(self.active):
+			if bounds in self._requests:
+				# Restart with the new settings
+				self.generate_latex(bounds)
+				continue
+
+			if not 'anchor' in bounds.data:
+				continue
+
+			text = self._rule.match(bounds.get_text()).group(1)
+			key = self._render_direct(bounds, text)
+
+			if key == None:
+				continue
+
+			filename = None
+
+			if not self.template.colored_dvi():
+				filename = self._lookup_dvi(bounds, text)
+
+			if filename:
+				dvis.setdefault(filename, []).append((bounds.data['dvi'][1], bounds, key))
+			else:
+				self.generate_latex(bounds)
+
+		if not dvis:
+			return False
+
+		# Rasterise all the formulas again in a single pass, without running
+		# latex
+		args = []
+		items = []
+
+		for filename in dvis:
+			idx = len(args)
+			args.append((filename, map(lambda x: x[0], dvis[filename])))
+
+			for page, bounds, key in dvis[filename]:
+				items.append((idx, page, bounds, key))
+
+		dpi, color, rgb, font = self._settings
+
+		self._raster_job = RasterJob(args,
+		                             dpi,
+		                             self.template.foreground(color),
+		                             lambda job, ret: self._rasterised(job, ret, items))
+
+		return False
+
+	def on_style_changed(self, *args):
+		if self._rerender_id == 0:
+			self._rerender_id = glib.idle_add(self._rerender)
+
+	def generate_latex(self, bounds):
+		self._stop_running(bounds)
+		self._clear_error(bounds)
+
+		text = self._rule.match(bounds.get_text()).group(1)
+
+		if self._settings == None:
+			self._settings = self._render_settings()
+
+		key = self._render_direct(bounds, text)
+
+		if key == None:
+			return
+
+		dpi, color, rgb, font = self._settings
+
+		request = RenderRequest(self, bounds, text, key, color, dpi)
+		self._requests[bounds] = request
+
+		if self._quiet_remaining() > 0:
+			self._waiting.append(request)
+			self._schedule_waiting()
+		else:
+			self._submit(request)
+
+	def _quiet_remaining(self):
+		# Milliseconds left before the buffer has been quiet long enough
+		elapsed = (time.time() - self._last_edit) * 1000
+
+		return max(0, Constants.LATEX_RENDER_DELAY - elapsed)
+
+	def _schedule_waiting(self):
+		if self._waiting_id != 0:
+			glib.source_remove(self._waiting_id)
+
+		self._waiting_id = glib.timeout_add(int(self._quiet_remaining()) + 1, self._submit_waiting)
+
+	def _submit_waiting(self):
+		self._waiting_id = 0
+
+		if self._quiet_remaining() > 0:
+			self._schedule_waiting()
+			return False
+
+		waiting = self._waiting
+		self._waiting = []
+
+		for request in waiting:
+			self._submit(request)
+
+		return False
+
+	def on_user_action(self, buf):
+		self._last_edit = time.time()
+
+		if self._waiting:
+			self._schedule_waiting()
+
+	def _submit(self, request):
+		ValidatorLatex.tiers['latex'] += 1
+
+		# Formulas are rendered in batches by the queue, the ones closest to
+		# the visible area first
+		distance = self._offscreen_distance()
+
+		if distance != None and self.priority(request.bounds) > distance:
+			self._deferred.append(request)
+		else:
+			self._queue.submit(request)
 
 	def validate(self, bounds, match):
 		self.generate_latex(bounds)
@@ -306,6 +817,7 @@ class ValidatorLatex(ValidatorHide):
 	def invalidate(self, bounds):
 		self._stop_running(bounds)
 		self._remove_pixbuf(bounds)
+		self._clear_error(bounds)
 
 		ValidatorHide.invalidate(self, bounds)
 
@@ -318,11 +830,14 @@ class ValidatorLatex(ValidatorHide):
 		self._remove_pixbuf(bounds)
 
 	def store_for_save(self, bounds):
+		# The anchor is deleted, which destroys its images, and created again
+		# with new images from the pixbuf on restore. The text stays hidden,
+		# so only the tags are not applied again
 		if 'anchor' in bounds.data:
-			self._remove_pixbuf(bounds)
+			self._detach_anchor(bounds)
 			bounds.data['restore_image'] = True
 
 	def restore_after_save(self, bounds):
 		if 'restore_image' in bounds.data:
-			self._show_pixbuf(bounds)
+			self._attach_anchor(bounds)
 			del bounds.data['restore_image']
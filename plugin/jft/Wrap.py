@@ -0,0 +1,183 @@
+import re
+
+class Wrap:
+	"""Finds where to break a line which is too long
+
+	The visual length of a line counts tabs as tabsize characters, a meta tag
+	like {{link: label}} only as its label, and leaves out the dollars and the
+	command names of inline math. The line is scanned for these once, the
+	length of every prefix then follows from the one after it.
+	"""
+
+	_re_meta = re.compile('\{\{.*?:\s*(.*?)\s*\}\}')
+	_re_math = re.compile('\$.*?\$')
+	_re_command = re.compile('\\\\[a-z]+')
+	_re_special = re.compile('[\s${}]')
+
+	_closing = '$}'
+	_opening = '${'
+
+	# Characters which isspace accepts
+	spaces = ' \t\n\r\x0b\x0c'
+
+	# Formula previews are child anchors in the text
+	_anchor = u'\ufffc'.encode('utf-8')
+
+	def __init__(self, tabsize):
+		self._tabsize = tabsize
+
+	def _reductions(self, line):
+		# (end, amount) for every item which is shorter on screen
+		ret = []
+
+		for item in self._re_meta.finditer(line):
+			ret.append((item.end(), len(item.group(0)) - len(item.group(1))))
+
+		for item in self._re_math.finditer(line):
+			l = 2
+
+			for command in self._re_command.finditer(item.group(0)):
+				l += len(command.group(0)) - 1
+
+			ret.append((item.end(), l))
+
+		return ret
+
+	def length(self, line):
+		l = len(line) + (self._tabsize - 1) * line.count("\t")
+
+		for end, amount in self._reductions(line):
+			l -= amount
+
+		return l
+
+	def split(self, line, border):
+		"""split(line, border) -> (first, second), or (None, None)
+
+		Breaks at the last space, outside of math and braces, after which the
+		first part fits within the border. The second part is only split off
+		if it fits itself, otherwise the line is broken at the first space.
+		"""
+
+		reductions = self._reductions(line)
+		l = len(line) + (self._tabsize - 1) * line.count("\t")
+
+		for end, amount in reductions:
+			l -= amount
+
+		if l < border:
+			return None, None
+
+		# Only spaces, braces and dollars matter for breaking, walk those
+		# backwards keeping track of the length of the line before them
+		ends = sorted(reductions, reverse=True)
+		reduced = sum(map(lambda x: x[1], reductions))
+		tabs = line.count("\t")
+		wide = self._tabsize - 1
+
+		special = [m.start() for m in self._re_special.finditer(line)]
+		unbreakable = []
+		last = None
+		e = 0
+
+		for i in reversed(special):
+			if i < 2:
+				break
+
+			c = line[i]
+
+			if c == "\t":
+				tabs -= 1
+
+			while e < len(ends) and ends[e][0] > i:
+				reduced -= ends[e][1]
+				e += 1
+
+			if c in self._opening and \
+			   unbreakable and \
+			   unbreakable[-1] == self._closing[self._opening.index(c)]:
+				unbreakable.pop()
+			elif c in self._closing:
+				unbreakable.append(c)
+
+			if not unbreakable and c.isspace():
+				if i + wide * tabs - reduced < border:
+					second = line[i + 1:]
+
+					if self.length(second) > border - 1:
+						break
+
+					return line[0:i], second
+				else:
+					last = i
+
+		if last != None:
+			return line[0:last], line[last + 1:]
+		else:
+			return None, None
+
+	def words(self, text):
+		"""words(text) -> parts of text between the spaces it can be broken at"""
+
+		unbreakable = []
+		breaks = []
+
+		for i in reversed([m.start() for m in self._re_special.finditer(text)]):
+			c = text[i]
+
+			if c in self._opening and \
+			   unbreakable and \
+			   unbreakable[-1] == self._closing[self._opening.index(c)]:
+				unbreakable.pop()
+			elif c in self._closing:
+				unbreakable.append(c)
+
+			if not unbreakable and c.isspace():
+				breaks.append(i)
+
+		ret = []
+		end = len(text)
+
+		for i in breaks:
+			if i + 1 < end:
+				ret.append(text[i + 1:end])
+
+			end = i
+
+		if end > 0:
+			ret.append(text[0:end])
+
+		ret.reverse()
+		return ret
+
+	def fill(self, words, border, first, indent):
+		"""fill(words, border, first, indent) -> lines
+
+		Puts as many words on each line as fit within the border. The first
+		line starts with first, the others with indent.
+		"""
+
+		ret = []
+		line = [first]
+		l = self.length(first)
+		empty = True
+
+		for word in words:
+			w = self.length(word.replace(self._anchor, ''))
+
+			if empty:
+				line.append(word)
+				l += w
+			elif l + 1 + w < border:
+				line.append(' ')
+				line.append(word)
+				l += 1 + w
+			else:
+				ret.append(''.join(line))
+				line = [indent, word]
+				l = self.length(indent) + w
+
+			empty = False
+
+		ret.append(''.join(line))
+		return ret
@@ -1,5 +1,6 @@
 import gedit
 from WindowHelper import WindowHelper
+from LatexRender import WorkerClient
 
 class JFTPlugin(gedit.Plugin):
     def __init__(self):
@@ -7,11 +8,16 @@ class JFTPlugin(gedit.Plugin):
         self._instances = {}
 
     def activate(self, window):
+        # The render worker is shared by all windows
+        WorkerClient.default().acquire()
+
         self._instances[window] = WindowHelper(self, window)
 
     def deactivate(self, window):
         self._instances[window].deactivate()
         del self._instances[window]
 
+        WorkerClient.default().release()
+
     def update_ui(self, window):
         self._instances[window].update_ui()